@@ -0,0 +1,281 @@
+import asyncore
+import os
+import socket
+import sys
+from threading import Thread, RLock
+from PacketConnection import FramedPacketConnection
+
+def_start_byte = '\xfc'
+def_end_byte = '\xfd'
+def_escape_byte = '\xfe'
+def_octet_stuff_byte = '\x20'
+def_recv_size = 65536
+def_loop_timeout = 1.0
+
+# States
+connected = 1
+disconnected = 2
+ready = 3
+dead = 7
+
+D = False
+
+
+class EventLoop(object):
+    """
+    Drives any number of asynchronous connections from a single thread. The loop sleeps in poll() until
+    one of its sockets becomes readable or writable, so packets are handled as soon as they arrive and
+    no thread per connection is needed. Sending from other threads wakes the loop up through a pipe.
+    """
+    def __init__(self):
+        self.map = {}
+        self.running = False
+        self.thread = None
+        self.waker = _Waker(self.map)
+
+    """ Runs the loop in the calling thread until stop() is called """
+    def run(self, timeout = def_loop_timeout):
+        self.running = True
+        while self.running:
+            asyncore.loop(timeout, True, self.map, 1)
+
+    """ Runs the loop in a background thread """
+    def start(self, timeout = def_loop_timeout):
+        self.thread = Thread(target = self.run, args = (timeout,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Stops the loop and closes all of its sockets """
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        asyncore.close_all(self.map)
+
+    """ Interrupts a poll() that is currently waiting, e.g. because new data should be written """
+    def wake(self):
+        self.waker.wake()
+
+
+class _Waker(asyncore.file_dispatcher):
+    """ The reading end of a pipe that is used to wake up a waiting event loop """
+    def __init__(self, map):
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        os.close(read_fd)   # file_dispatcher works on a duplicate
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, "x")
+        except OSError:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def handle_close(self):
+        self.close()
+        os.close(self.write_fd)
+
+
+_default_loop = None
+
+""" Returns the event loop that is used by connections that are not given one explicitly """
+def default_loop():
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    return _default_loop
+
+
+class AsyncTCPConnection(FramedPacketConnection):
+    """
+    Creates a new framed TCP connection that is driven by an event loop instead of a listener thread.
+    The framing is the same as in TCPConnection, so both can talk to each other.
+
+    Received chunks are fed to the deframer as soon as the event loop sees them, and sent packets are
+    buffered and written whenever the socket can take them. Packets can be sent from any thread.
+
+    Parameters
+    ----------
+    callback : function
+       The function that newly arrived packets should be passed to. Should have exactly one argument.
+       It is called from the thread running the event loop.
+    loop: EventLoop
+       The loop that drives this connection. If not given, the shared default loop is used, which
+       has to be started with default_loop().start() or run with default_loop().run().
+    framed: boolean
+       Defines whether packets used in this connection are framed by start and end bytes. If false, each packet
+       will contain exactly 1 byte.
+    start_byte: byte
+       If framed = True, use this as the start byte of a packet (default: '\xfc')
+    end_byte: byte
+       If framed = True, use this as the end byte of a packet (default: '\xfd')
+    escape_byte: byte
+       If framed = True, use this as the escape character. (default: '\xfe')
+    octet_stuff_byte: byte
+       If framed = True, use this byte to do octet stuffing and unstuffing on escaped characters.
+    framing: function
+       If given, is called to create the framing object of this connection, e.g. Framing.CobsFraming or
+       Framing.LengthPrefixFraming. The byte arguments above are then ignored. Both sides of a connection
+       have to use the same framing.
+
+    """
+    def __init__(self, callback, loop = None, framed = True, start_byte = def_start_byte, end_byte = def_end_byte,
+                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte, framing = None):
+        FramedPacketConnection.__init__(self, callback, False, framed, start_byte, end_byte, escape_byte, octet_stuff_byte,
+                                        framing)
+        if loop is None:
+            loop = default_loop()
+        self.loop = loop
+        self.dispatcher = None
+        self.acceptor = None
+        self.out_buffer = bytearray()
+        self.out_lock = RLock()   # send() may close the socket, which clears the buffer
+        self.error = None   # The exception that ended the connection, see connection_failed()
+        self.state = disconnected
+
+    """ Open port and let the first device that connects become the peer of this connection. Does not block. """
+    def createServer(self, port = 5000):
+        self.server = True
+        self.port = port
+        self.acceptor = _Acceptor(self.loop.map, port, self.attach)
+        self.loop.wake()
+
+    """ Actively connect to another device with an address. Does not block. """
+    def createClient(self, address, port = 5000):
+        self.server = False
+        self.address = address
+        self.dispatcher = _SocketDispatcher(self, None, self.loop.map)
+        self.dispatcher.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.dispatcher.connect((address, port))
+        self.dispatcher.active = True
+        self.loop.wake()
+
+    """ Use an already connected socket for this connection. Should only be used internally. """
+    def attach(self, sock, address = None):
+        if self.acceptor is not None:
+            self.acceptor.close()
+            self.acceptor = None
+        self.dispatcher = _SocketDispatcher(self, sock, self.loop.map)
+        self.change_state(ready)
+
+    """ Buffer raw data to be written by the event loop. This method should only be used internally. """
+    def sendData(self, data, frames = 1):
+        if self.state != ready and self.state != connected:
+            if D: print "Connection is not ready, cannot send packet!"
+            if self.hooks:
+                self.report_dropped(frames, "not ready")
+            return
+        with self.out_lock:
+            was_empty = len(self.out_buffer) == 0
+            self.out_buffer += data
+        if was_empty:
+            self.loop.wake()
+
+    """ Frames a packet and queues it for sending """
+    def send(self, pck):
+        self.sendPacket(pck)
+
+    """ Writes as much of the buffered data as the socket takes. Should only be called by the event loop. """
+    def write_buffered(self, dispatcher):
+        with self.out_lock:
+            sent = dispatcher.send(self.out_buffer)
+            del self.out_buffer[:sent]
+        for hook in self.hooks:
+            hook.bytes_sent(self, sent)
+
+    def has_buffered_data(self):
+        return len(self.out_buffer) > 0
+
+    """ Called by the event loop when the peer closed the connection or the socket failed """
+    def connection_lost(self):
+        if D: print "AsyncTCPConnection lost"
+        self.reset_receive_state()
+        self.dispatcher = None
+        with self.out_lock:
+            del self.out_buffer[:]
+        if self.state != dead:
+            self.change_state(disconnected)
+
+    """ Called by the event loop when connecting failed or handling an event raised an exception. The connection
+        is closed for good. """
+    def connection_failed(self, error):
+        if D: print "AsyncTCPConnection failed: " + repr(error)
+        self.error = error
+        self.connection_lost()
+        self.change_state(dead)
+
+    """ Closes the socket """
+    def closeConnection(self):
+        self.stop_recording()
+        if self.acceptor is not None:
+            self.acceptor.close()
+            self.acceptor = None
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+            self.dispatcher = None
+        self.change_state(dead)
+        self.loop.wake()
+
+
+class _SocketDispatcher(asyncore.dispatcher):
+    """ Moves bytes between a connected socket and an AsyncTCPConnection """
+    def __init__(self, conn, sock, map):
+        # A socket that is not connected yet polls as writable. A client socket is created in the map before
+        # connect() is called, so the loop must ignore it until then, or it would take it for connected.
+        self.active = sock is not None
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.conn = conn
+
+    def readable(self):
+        return self.active
+
+    def handle_connect(self):
+        if D: print "Connected!"
+        self.conn.change_state(ready)
+
+    def handle_read(self):
+        dat = self.recv(def_recv_size)
+        if dat:
+            self.conn.data_callback(dat)
+
+    def writable(self):
+        # While connecting, writability signals that the connection was established
+        return self.active and ((not self.connected) or self.conn.has_buffered_data())
+
+    def handle_write(self):
+        self.conn.write_buffered(self)
+
+    def handle_close(self):
+        self.close()
+        self.conn.connection_lost()
+
+    def handle_error(self):
+        # Replaces asyncore's handler, which prints the traceback and leaves the connection disconnected
+        error = sys.exc_info()[1]
+        self.close()
+        self.conn.connection_failed(error)
+
+
+class _Acceptor(asyncore.dispatcher):
+    """ A listening socket that hands every accepted socket to a function """
+    def __init__(self, map, port, on_accept, backlog = 5):
+        asyncore.dispatcher.__init__(self, None, map)
+        self.on_accept = on_accept
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(("", port))
+        self.listen(backlog)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, address = pair
+            if D: print "Now connected to " + repr(address)
+            self.on_accept(sock, address)
@@ -0,0 +1,89 @@
+from threading import Thread, Lock, Condition
+from time import time
+
+def_max_bytes = 16384
+def_max_delay = .002
+
+D = False
+
+
+class Batcher(object):
+    """
+    Collects the frames of a connection in a buffer and writes them together, to save system calls
+    for many small frames. The buffer is flushed as soon as it holds max_bytes bytes, or max_delay
+    seconds after the first frame was added to it, whichever comes first, so batching delays a
+    frame by at most max_delay. A timer thread takes care of the deadline.
+
+    Parameters
+    ----------
+
+    connection: FramedPacketConnection
+        The connection whose send_now() method is used to send the batches.
+    max_bytes: int
+        The buffer is flushed when it holds at least this many bytes.
+    max_delay: float
+        The maximum time in seconds a frame is held back.
+    """
+    def __init__(self, connection, max_bytes = def_max_bytes, max_delay = def_max_delay):
+        self.connection = connection
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.buffer = bytearray()
+        self.frames = 0
+        self.deadline = None
+        self.condition = Condition(Lock())
+        self.flush_lock = Lock()   # Keeps batches in order
+        self.batches = 0
+        self.batched_frames = 0
+        self.running = True
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Adds frames to the buffer and flushes it if it is full """
+    def add(self, data, frames = 1):
+        with self.condition:
+            if not self.buffer:
+                self.deadline = time() + self.max_delay
+                self.condition.notify()
+            self.buffer += data
+            self.frames += frames
+            full = len(self.buffer) >= self.max_bytes
+        if full:
+            self.flush()
+
+    """ Sends the buffered frames now """
+    def flush(self):
+        with self.flush_lock:
+            with self.condition:
+                if not self.buffer:
+                    return
+                data = self.buffer
+                frames = self.frames
+                self.buffer = bytearray()
+                self.frames = 0
+                self.deadline = None
+            self.batches += 1
+            self.batched_frames += frames
+            if D: print "Flushing %d frames in %d bytes" % (frames, len(data))
+            self.connection.send_now(data, frames)
+
+    """ Flushes the buffer and stops the timer thread """
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (self.deadline is None or self.deadline > time()):
+                    if self.deadline is None:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(self.deadline - time())
+                if not self.running:
+                    return
+            self.flush()
@@ -0,0 +1,561 @@
+"""
+Benchmarks for the Packet codecs, the framing and the transports. Run
+
+    python Benchmark.py [--quick] [--output results.json]
+
+to print the results as JSON, so that they can be compared between versions.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import timeit
+import types
+from time import time
+
+import PacketConnection
+import TCPConnection as tcp_module
+from Compression import Compressor
+from Framing import ByteStuffingFraming, LengthPrefixFraming, CobsFraming
+from Instrumentation import ConnectionStats
+from LoopbackConnection import loopback_pair
+from Packet import Packet
+from RPC import RPCEndpoint
+from PacketConnection import FramedPacketConnection, ready
+from TCPConnection import TCPConnection
+
+def_sizes = (1000, 10000, 100000)
+def_payload_sizes = (64, 1024, 65536)
+def_escape_densities = (0., .01, .1, .5)
+def_repeat = 3
+
+_escaped_bytes = "\xfc\xfd\xfe"
+
+_framings = [("byte_stuffing", ByteStuffingFraming),
+             ("length_prefix", LengthPrefixFraming),
+             ("cobs", CobsFraming)]
+
+
+""" Returns the smallest time of several runs of fn """
+def best_time(fn, repeat = def_repeat):
+    return min(timeit.repeat(fn, number = 1, repeat = repeat))
+
+
+""" Returns the p-th percentile of a sorted list """
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100. * (len(values) - 1))))]
+
+
+""" Returns a random payload in which about the given fraction of bytes needs escaping """
+def make_payload(size, escape_density, seed = 0):
+    rnd = random.Random(seed)
+    plain = [chr(rnd.randint(0, 0xfb)) for _ in range(size)]
+    for i in rnd.sample(xrange(size), int(size * escape_density)):
+        plain[i] = rnd.choice(_escaped_bytes)
+    return "".join(plain)
+
+
+### Packet ###
+
+""" Appends n floats to a packet one by one and pops them again. """
+def append_pop_floats(n, buffered):
+    pck = Packet(buffered = buffered)
+    for i in xrange(n):
+        pck.append_float(i)
+    pck.position = 0
+    for _ in xrange(n):
+        pck.pop_float()
+
+
+""" Compares string and bytearray storage of packets for payloads of the given numbers of elements. """
+def bench_packet_storage(sizes = def_sizes, repeat = def_repeat):
+    results = []
+    for n in sizes:
+        str_time = best_time(lambda: append_pop_floats(n, False), repeat)
+        buf_time = best_time(lambda: append_pop_floats(n, True), repeat)
+        results.append({"elements": n, "str_seconds": str_time, "buffered_seconds": buf_time,
+                        "speedup": str_time / buf_time})
+    return results
+
+
+_codec_cases = [
+    ("int", lambda pck: pck.append_int(7), lambda pck: pck.pop_int()),
+    ("float", lambda pck: pck.append_float(.5), lambda pck: pck.pop_float()),
+    ("char", lambda pck: pck.append_char("x"), lambda pck: pck.pop_char()),
+    ("string", lambda pck: pck.append_string("sixteen chars..."), lambda pck: pck.pop_string()),
+    ("float_list", lambda pck: pck.append_float_list(range(100)), lambda pck: pck.pop_float_list()),
+    ("int_list", lambda pck: pck.append_int_list(range(100)), lambda pck: pck.pop_int_list()),
+]
+
+""" Measures how many values of each type can be appended to and popped from a packet per second """
+def bench_packet_codecs(n = 10000, repeat = def_repeat):
+    results = []
+    for name, append, pop in _codec_cases:
+        for buffered in (False, True):
+            filled = Packet(buffered = buffered)
+            for _ in xrange(n):
+                append(filled)
+
+            def run_append():
+                pck = Packet(buffered = buffered)
+                for _ in xrange(n):
+                    append(pck)
+
+            def run_pop():
+                filled.position = 0
+                for _ in xrange(n):
+                    pop(filled)
+
+            results.append({"type": name, "buffered": buffered,
+                            "appends_per_second": n / best_time(run_append, repeat),
+                            "pops_per_second": n / best_time(run_pop, repeat)})
+    return results
+
+
+### Framing ###
+
+""" Measures encoding and decoding speed of each framing strategy in MB/s """
+def bench_framing(payload_sizes = def_payload_sizes, escape_densities = def_escape_densities,
+                  total_bytes = 1 << 20, repeat = def_repeat):
+    results = []
+    for name, framing in _framings:
+        for size in payload_sizes:
+            for density in escape_densities:
+                payload = make_payload(size, density)
+                count = max(1, total_bytes // size)
+                pcks = []
+                for _ in range(count):
+                    pck = Packet()
+                    pck.put_data(payload)
+                    pcks.append(pck)
+
+                conn = _SinkConnection(framing)
+                encode_time = best_time(lambda: [conn.sendPacket(pck) for pck in pcks], repeat)
+                stream = conn.framing.encode(payload) * count
+
+                received = []
+                receiver = FramedPacketConnection(received.append, framing = framing)
+                chunks = [stream[i:i + PacketConnection.def_recv_size]
+                          for i in xrange(0, len(stream), PacketConnection.def_recv_size)]
+                decode_time = best_time(lambda: [receiver.data_callback(chunk) for chunk in chunks], repeat)
+                assert len(received) == count * repeat
+
+                megabytes = size * count / 1e6
+                results.append({"framing": name, "payload_size": size, "escape_density": density,
+                                "encode_mb_per_second": megabytes / encode_time,
+                                "decode_mb_per_second": megabytes / decode_time,
+                                "overhead": float(len(stream)) / (size * count)})
+    return results
+
+
+class _SinkConnection(FramedPacketConnection):
+    """ A connection that discards everything it sends """
+    def __init__(self, framing = None):
+        FramedPacketConnection.__init__(self, None, framing = framing)
+        self.state = ready
+
+    def sendData(self, data, frames = 1):
+        pass
+
+
+""" Compares the decoding speed without hooks and with a ConnectionStats hook attached """
+def bench_instrumentation(payload_size = 1024, total_bytes = 1 << 20, repeat = def_repeat):
+    payload = make_payload(payload_size, .01)
+    count = max(1, total_bytes // payload_size)
+    frame = FramedPacketConnection(None).framing.encode(payload)
+    chunks = [frame * 64] * (count // 64)
+    results = {}
+    for name, hook in (("no_hook", None), ("stats_hook", ConnectionStats())):
+        receiver = FramedPacketConnection(lambda pck: None)
+        if hook is not None:
+            receiver.add_hook(hook)
+        seconds = best_time(lambda: [receiver.data_callback(chunk) for chunk in chunks], repeat)
+        results[name + "_mb_per_second"] = payload_size * 64 * len(chunks) / seconds / 1e6
+    return results
+
+
+### Compression ###
+
+_link_rates = (("rfcomm_250kbit", 250e3 / 8), ("rfcomm_1mbit", 1e6 / 8), ("wifi_20mbit", 20e6 / 8))
+
+""" Returns n float lists that look like slowly changing sensor readings, as packet payloads """
+def sensor_payloads(n = 200, floats = 1000, seed = 0):
+    rnd = random.Random(seed)
+    payloads = []
+    value = 0.
+    for _ in range(n):
+        pck = Packet()
+        readings = []
+        for _ in range(floats):
+            value += rnd.choice((-1, 0, 0, 0, 1)) * .5
+            readings.append(value)
+        pck.append_float_list(readings)
+        payloads.append(pck.get_data())
+    return payloads
+
+
+""" Compares the effective payload throughput with and without compression on simulated slow links. 
+    Compressing and decompressing is timed on this machine, the transmission time is computed from 
+    the link rate. """
+def bench_compression(levels = (1, 6, 9), repeat = def_repeat):
+    payloads = sensor_payloads()
+    payload_bytes = sum(len(data) for data in payloads)
+    results = []
+    for level in (None,) + tuple(levels):
+        if level is None:
+            cpu_time = 0.
+            wire_bytes = payload_bytes
+        else:
+            compressor = Compressor(level = level)
+            packed = [compressor.compress(data) for data in payloads]
+            wire_bytes = sum(len(data) for data in packed)
+            cpu_time = best_time(lambda: [compressor.decompress(compressor.compress(data)) for data in payloads], repeat)
+        for link, rate in _link_rates:
+            results.append({"level": level, "link": link,
+                            "ratio": float(wire_bytes) / payload_bytes,
+                            "cpu_seconds_per_mb": cpu_time / payload_bytes * 1e6,
+                            "effective_kb_per_second": payload_bytes / (cpu_time + wire_bytes / rate) / 1e3})
+    return results
+
+
+### Transports ###
+
+""" Returns a TCP port that is currently free """
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+""" Connects a TCPConnection server and client on the loopback interface """
+def tcp_pair(server_callback, client_callback, nodelay = False):
+    port = free_port()
+    server = TCPConnection(server_callback, auto_reconnect = False)
+    thread = threading.Thread(target = server.createServer, args = (port,), kwargs = {"nodelay": nodelay})
+    thread.start()
+    client = TCPConnection(client_callback, auto_reconnect = False)
+    client.createClient("127.0.0.1", port, nodelay = nodelay)
+    thread.join()
+    return server, client
+
+
+""" Measures throughput and round trip latency of two TCPConnections on the loopback interface """
+def bench_tcp_loopback(payload_sizes = def_payload_sizes, total_bytes = 4 << 20, round_trips = 1000):
+    results = []
+    for size in payload_sizes:
+        payload = make_payload(size, .01)
+        count = max(1, total_bytes // size)
+        received = []
+        done = threading.Event()
+
+        def server_callback(pck):
+            received.append(len(pck.get_data()))
+            if len(received) == count:
+                done.set()
+
+        server, client = tcp_pair(server_callback, lambda pck: None)
+        try:
+            pck = Packet()
+            pck.put_data(payload)
+            start = time()
+            for _ in xrange(count):
+                client.sendPacket(pck)
+            done.wait(60)
+            throughput = size * len(received) / (time() - start) / 1e6
+        finally:
+            client.closeConnection()
+            server.closeConnection()
+
+        echoed = threading.Event()
+        server, client = tcp_pair(lambda pck: server.sendPacket(pck), lambda pck: echoed.set())
+        try:
+            latencies = []
+            for _ in xrange(round_trips):
+                echoed.clear()
+                start = time()
+                client.sendPacket(pck)
+                echoed.wait(5)
+                latencies.append(time() - start)
+            latencies.sort()
+        finally:
+            client.closeConnection()
+            server.closeConnection()
+
+        results.append({"payload_size": size, "mb_per_second": throughput,
+                        "rtt_p50_ms": percentile(latencies, 50) * 1e3,
+                        "rtt_p99_ms": percentile(latencies, 99) * 1e3})
+    return results
+
+
+""" Compares sending many small packets over the loopback interface with Nagle's algorithm, with
+    TCP_NODELAY, and with TCP_NODELAY and batching """
+def bench_batching(payload_size = 32, count = 100000, round_trips = 1000):
+    results = []
+    pck = Packet()
+    pck.put_data(make_payload(payload_size, .01))
+    for mode in ("nagle", "nodelay", "batched"):
+        received = []
+        done = threading.Event()
+
+        def server_callback(pck):
+            received.append(1)
+            if len(received) == count:
+                done.set()
+
+        server, client = tcp_pair(server_callback, lambda pck: None, nodelay = mode != "nagle")
+        try:
+            if mode == "batched":
+                client.enable_batching()
+            start = time()
+            for _ in xrange(count):
+                client.sendPacket(pck)
+            client.flush()
+            done.wait(60)
+            rate = len(received) / (time() - start)
+            writes = client.batcher.batches if mode == "batched" else count
+        finally:
+            client.closeConnection()
+            server.closeConnection()
+
+        echoed = threading.Event()
+        server, client = tcp_pair(lambda pck: server.sendPacket(pck), lambda pck: echoed.set(),
+                                  nodelay = mode != "nagle")
+        try:
+            if mode == "batched":
+                client.enable_batching()
+                server.enable_batching()
+            latencies = []
+            for _ in xrange(round_trips):
+                echoed.clear()
+                start = time()
+                client.sendPacket(pck)
+                echoed.wait(5)
+                latencies.append(time() - start)
+            latencies.sort()
+        finally:
+            client.closeConnection()
+            server.closeConnection()
+
+        results.append({"mode": mode, "packets_per_second": rate, "writes": writes,
+                        "rtt_p50_ms": percentile(latencies, 50) * 1e3,
+                        "rtt_p99_ms": percentile(latencies, 99) * 1e3})
+    return results
+
+
+""" Measures the receive path for small frames with and without a PacketPool. Reports the time per frame,
+    the number of packets allocated per frame and the size of a packet. """
+def bench_packet_pool(payload_size = 16, frames_per_chunk = 100, chunks = 1000, repeat = def_repeat):
+    results = []
+    framing = ByteStuffingFraming()
+    chunk = framing.encode(make_payload(payload_size, 0)) * frames_per_chunk
+    for mode in ("new", "pool"):
+        conn = FramedPacketConnection(lambda pck: pck.release())
+        if mode == "pool":
+            conn.enable_packet_pool()
+
+        def run():
+            for _ in xrange(chunks):
+                conn.data_callback(chunk)
+        seconds = best_time(run, repeat)
+        frames = frames_per_chunk * chunks * repeat
+        allocated = conn.packet_pool.created if mode == "pool" else frames
+        results.append({"mode": mode, "us_per_frame": seconds / (frames_per_chunk * chunks) * 1e6,
+                        "packets_allocated_per_frame": allocated / float(frames),
+                        "bytes_per_packet": sys.getsizeof(Packet())})
+    return results
+
+
+""" Measures the protocol layer alone: packets are sent through a pair of in-memory connections, which deliver
+    the bytes on the sending thread """
+def bench_loopback(payload_sizes = def_payload_sizes, total_bytes = 4 << 20, repeat = def_repeat):
+    results = []
+    for name, framing in _framings:
+        for size in payload_sizes:
+            pck = Packet()
+            pck.put_data(make_payload(size, .01))
+            count = max(1, total_bytes // size)
+            received = []
+            a, b = loopback_pair(None, received.append, framing = framing)
+
+            def run():
+                del received[:]
+                for _ in xrange(count):
+                    a.sendPacket(pck)
+            seconds = best_time(run, repeat)
+            a.closeConnection()
+            results.append({"framing": name, "payload_size": size, "packets_per_second": count / seconds,
+                            "mb_per_second": size * count / seconds / 1e6})
+    return results
+
+
+""" Compares RPC calls made one after another with pipelined calls over an in-memory link with latency """
+def bench_rpc(latency = .01, calls = 200):
+    a, b = loopback_pair(None, None, latency = latency)
+    client = RPCEndpoint(a)
+    server = RPCEndpoint(b, lambda pck: pck)
+    pck = Packet()
+    pck.put_data(make_payload(64, 0))
+    try:
+        start = time()
+        for _ in xrange(calls):
+            client.request(pck)
+        sequential = time() - start
+        start = time()
+        for future in [client.call(pck) for _ in xrange(calls)]:
+            future.result()
+        pipelined = time() - start
+    finally:
+        client.close()
+        server.close()
+        a.closeConnection()
+    return {"latency_ms": latency * 1e3, "calls": calls,
+            "sequential_calls_per_second": calls / sequential,
+            "pipelined_calls_per_second": calls / pipelined}
+
+
+class FakeRFCOMMSocket(object):
+    """ Stands in for a BluetoothSocket. Returns the given bytes from recv() and collects sent bytes. """
+    def __init__(self, incoming = "", error = None):
+        self.incoming = incoming
+        self.position = 0
+        self.sent = []
+        self.error = error
+
+    def recv(self, size):
+        if self.position >= len(self.incoming):
+            raise self.error("connection lost")
+        dat = self.incoming[self.position:self.position + size]
+        self.position += len(dat)
+        return dat
+
+    def send(self, data):
+        self.sent.append(str(data))
+        return len(data)
+
+    def sendall(self, data):
+        self.sent.append(str(data))
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+""" Imports BluetoothConnection. Without PyBluez, a stand-in bluetooth module is used for the import only,
+    since the benchmark never touches a real socket; neither module is left in sys.modules, so other code
+    still sees that PyBluez is missing. """
+def import_bluetooth_connection():
+    try:
+        import BluetoothConnection as bt_module
+        return bt_module
+    except ImportError:
+        pass
+    stub = types.ModuleType("bluetooth")
+    stub.BluetoothError = type("BluetoothError", (IOError,), {})
+    stub.BluetoothSocket = FakeRFCOMMSocket
+    stub.RFCOMM = 3
+    stub.discover_devices = lambda *args, **kwargs: []
+    sys.modules["bluetooth"] = stub
+    try:
+        import BluetoothConnection as bt_module
+    finally:
+        del sys.modules["bluetooth"]
+        sys.modules.pop("BluetoothConnection", None)
+    return bt_module
+
+
+""" Measures the receive and send path of a BluetoothConnection on a fake RFCOMM socket """
+def bench_bluetooth(payload_sizes = def_payload_sizes, total_bytes = 1 << 20, repeat = def_repeat):
+    bt_module = import_bluetooth_connection()
+    BluetoothError = bt_module.BluetoothError
+    bt_module.D = False
+    results = []
+    for size in payload_sizes:
+        payload = make_payload(size, .01)
+        count = max(1, total_bytes // size)
+        received = []
+        conn = bt_module.BluetoothConnection(received.append)
+        stream = conn.framing.encode(payload) * count
+
+        def receive():
+            fake = FakeRFCOMMSocket(stream, BluetoothError)
+            bt_module.ConnectedThread(fake, conn.data_callback).run()
+
+        receive_time = best_time(receive, repeat)
+        assert len(received) == count * repeat
+
+        pck = Packet()
+        pck.put_data(payload)
+        conn.client_socket = FakeRFCOMMSocket()
+        conn.state = ready
+        send_time = best_time(lambda: [conn.sendPacket(pck) for _ in xrange(count)], repeat)
+
+        megabytes = size * count / 1e6
+        results.append({"payload_size": size, "receive_mb_per_second": megabytes / receive_time,
+                        "send_mb_per_second": megabytes / send_time})
+    return results
+
+
+""" Measures in a fresh interpreter how long importing each module takes, and which optional dependencies
+    it pulls in. Importing the core should neither need PyBluez nor a debugger. """
+def bench_import(modules = ("Packet", "Framing", "PacketConnection", "TCPConnection", "Transports"), repeat = def_repeat):
+    script = ("import sys, time; start = time.time(); import %s; elapsed = time.time() - start; "
+              "print elapsed; print ' '.join(m for m in ('bluetooth', 'ipdb', 'numpy') if m in sys.modules)")
+    results = []
+    for module in modules:
+        times = []
+        for _ in xrange(repeat):
+            output = subprocess.check_output([sys.executable, "-c", script % module],
+                                             cwd = os.path.dirname(os.path.abspath(__file__)))
+            lines = output.splitlines()
+            times.append(float(lines[0]))
+        results.append({"module": module, "import_ms": min(times) * 1e3,
+                        "optional_imported": lines[1].split() if len(lines) > 1 else []})
+    return results
+
+
+""" Runs all benchmarks and returns their results as a dict """
+def run_all(quick = False):
+    if quick:
+        sizes, payload_sizes, repeat = (1000, 10000), (64, 1024), 1
+    else:
+        sizes, payload_sizes, repeat = def_sizes, def_payload_sizes, def_repeat
+    return {"python": sys.version.split()[0],
+            "time": time(),
+            "import": bench_import(repeat = repeat),
+            "packet_storage": bench_packet_storage(sizes, repeat),
+            "packet_codecs": bench_packet_codecs(1000 if quick else 10000, repeat),
+            "framing": bench_framing(payload_sizes, repeat = repeat),
+            "instrumentation": bench_instrumentation(repeat = repeat),
+            "compression": bench_compression(repeat = repeat),
+            "bluetooth_fake_socket": bench_bluetooth(payload_sizes, repeat = repeat),
+            "tcp_loopback": bench_tcp_loopback(payload_sizes, round_trips = 100 if quick else 1000),
+            "packet_pool": bench_packet_pool(chunks = 100 if quick else 1000, repeat = repeat),
+            "loopback": bench_loopback(payload_sizes, repeat = repeat),
+            "rpc": bench_rpc(calls = 50 if quick else 200),
+            "batching": bench_batching(count = 10000 if quick else 100000, round_trips = 100 if quick else 1000)}
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks for packets, framing and transports")
+    parser.add_argument("--quick", action = "store_true", help = "Smaller sizes and fewer repetitions")
+    parser.add_argument("--output", help = "Also write the results to this file")
+    args = parser.parse_args()
+
+    PacketConnection.D = False
+    tcp_module.D = False
+    results = run_all(args.quick)
+    text = json.dumps(results, indent = 2, sort_keys = True)
+    print text
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
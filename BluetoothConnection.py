@@ -1,13 +1,14 @@
 from bluetooth import BluetoothSocket, RFCOMM, discover_devices, BluetoothError
 from threading import Thread
-import ipdb
 from PacketConnection import FramedPacketConnection
+from Supervisor import Supervisor
 
 def_start_byte = '\xfc'
 def_end_byte = '\xfd'
 def_escape_byte = '\xfe'
 def_octet_stuff_byte = '\x20'
 def_max_packet_size = 232
+def_recv_size = 65536
 
 # States
 connected = 1
@@ -18,7 +19,7 @@ escaping = 5
 received = 6
 dead = 7
 
-D = True
+D = False
     
 class BluetoothConnection(FramedPacketConnection):
     """
@@ -27,7 +28,9 @@ class BluetoothConnection(FramedPacketConnection):
     Parameters
     ----------
     callback : function
-       The function that newly arrived packets should be passed to. Should have exactly one argument. 
+       The function that newly arrived packets should be passed to. Should have exactly one argument.
+       May be None if the packets are fetched with packets() or recv_batch() instead.
+       The receive buffer is then enabled right away.
     auto_reconnect: boolean
        Defines whether the socket should be automatically reopened after connection loss.
     framed: boolean
@@ -41,60 +44,104 @@ class BluetoothConnection(FramedPacketConnection):
        If framed = True, use this as the escape character. (default: '\xfe')
     octet_stuff_byte: byte
        If framed = True, use this byte to do octet stuffing and unstuffing on escaped characters. 
+    framing: function
+       If given, is called to create the framing object of this connection, e.g. Framing.CobsFraming or
+       Framing.LengthPrefixFraming. The byte arguments above are then ignored. Both sides of a connection
+       have to use the same framing.
+    discovery: Discovery.DeviceCache
+       If given, device searches are answered from this cache, and every device a client connects to is
+       added to its address book, so createClient("first") does not have to wait for an inquiry scan.
        
     """
     def __init__(self, callback, auto_reconnect = True, framed = True, start_byte = def_start_byte, end_byte = def_end_byte, 
-                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte):
-        FramedPacketConnection.__init__(self, callback, auto_reconnect, framed, start_byte, end_byte, escape_byte, octet_stuff_byte)
+                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte, framing = None,
+                 discovery = None):
+        FramedPacketConnection.__init__(self, callback, auto_reconnect, framed, start_byte, end_byte, escape_byte, octet_stuff_byte,
+                                        framing)
         self.client_socket = None
         self.server_socket = None
+        self.supervisor = None
+        self.discovery = discovery
         self.state = disconnected
-        self.running = True
         
-    """ Open port and wait for other devices to connect """
-    def createServer(self, port = 3):
+    """ Open port and wait for other devices to connect. Blocks until the connection is closed; 
+        if auto_reconnect is set, the next device is accepted whenever a connection was lost. """
+    def createServer(self, port = 3, backoff = None):
         self.server_socket=BluetoothSocket( RFCOMM )
         self.server_socket.bind(("", port))
         self.server_socket.listen(1)
         self.server_socket.settimeout(.5)
-        
+        self.supervisor = Supervisor(self, self.accept, self.receive, backoff = backoff)
+        self.supervisor.start(block = True)
+    
+    """ Actively connect to another device with an address. Returns once the connection is open; 
+        failed attempts are retried with the delays given by backoff (see Supervisor.Backoff). """
+    def createClient(self, address, port = 3, backoff = None):
+        if address == "first":
+            address = self.searchDevices()[0]
+        self.address = address
+        self.port = port
+        self.supervisor = Supervisor(self, self.connect, self.receive, backoff = backoff)
+        self.supervisor.start()
+        self.supervisor.wait_connected()
+    
+    """ Accepts the next device on the server socket. Should only be used internally. """
+    def accept(self):
         while True:
-            if not self.running:
-                break
             if D: print "Trying to connect.."
+            server_socket = self.server_socket
+            if server_socket is None or not self.supervisor.running:
+                raise BluetoothError("Server socket was closed")
             try:
-                self.client_socket, _ = self.server_socket.accept()
-                self.client_socket.settimeout(.5)
+                self.client_socket, _ = server_socket.accept()
+                break
             except BluetoothError:
                 self.change_state(disconnected)
-                continue
-                
-            if D: print "Connected!"
-            self.change_state(ready)
-        
-            conn_thread = ConnectedThread(self.client_socket, self.byte_callback)
-            conn_thread.run()
-            
-            
-            if not self.auto_reconnect:
-                break
+                if not self.supervisor.running:
+                    raise
+        self.client_socket.settimeout(.5)
+        if D: print "Connected!"
+        self.change_state(ready)
     
-    """ Actively connect to another device with an address """
-    def createClient(self, address, port = 3):
-        if address == "first":
-            address = self.searchDevices()[0]
-        self.client_socket=BluetoothSocket( RFCOMM )
+    """ Makes one attempt to connect to the device. Should only be used internally. """
+    def connect(self):
+        client_socket = BluetoothSocket( RFCOMM )
         if D: print "Trying to connect.."
-        self.client_socket.connect((address, port))
+        try:
+            client_socket.connect((self.address, self.port))
+        except BluetoothError:
+            client_socket.close()
+            raise
+        client_socket.settimeout(.5)
+        self.client_socket = client_socket
+        if self.discovery is not None:
+            self.discovery.remember(self.address)
         if D: print "Connected!"
         self.change_state(ready)
     
-    """ Returns a list of currently discovered devices """
+    """ Runs the receive loop until the connection is lost. Should only be used internally. """
+    def receive(self):
+        ConnectedThread(self.client_socket, self.data_callback).run()
+        self.connection_reset()
+    
+    """ Returns whether a socket error only says that the timeout of the socket expired """
+    def is_timeout(self, error):
+        return isinstance(error, BluetoothError) and error.message == "timed out"
+    
+    """ Returns a list of currently discovered devices, from the discovery cache if there is one """
     def searchDevices(self):
+        if self.discovery is not None:
+            return self.discovery.devices()
         return discover_devices()
     
     """ Closes the bluetooth socket """
     def closeConnection(self):
+        self.disable_batching()
+        self.disable_send_queue()
+        self.stop_recording()
+        self.change_state(dead)
+        if self.supervisor is not None:
+            self.supervisor.stop()
         if self.server_socket is not None:
             if (D): print "Closing server socket"
             self.server_socket.close()
@@ -104,21 +151,22 @@ class BluetoothConnection(FramedPacketConnection):
             if (D): print "Closing client socket"
             self.client_socket.close()
             self.client_socket = None
-            
-        self.change_state(dead)
-        self.running = False
+        
+        if self.supervisor is not None:
+            self.supervisor.join()
 
         
 # A thread that waits on the open socket for incoming bytes
 class ConnectedThread(Thread):
-    def __init__(self, socket, callback):
+    def __init__(self, socket, callback, recv_size = def_recv_size):
         self.callback = callback
         self.socket = socket
+        self.recv_size = recv_size
         
     def run(self):
         while True:
             try:
-                dat = self.socket.recv(1)
+                dat = self.socket.recv(self.recv_size)
                 self.callback(dat)
             except BluetoothError, e:
                 if e.message=="timed out":
@@ -0,0 +1,47 @@
+import Queue
+
+# Overflow policies
+block = 1   # Wait until there is room in the queue
+drop = 2    # Discard the new item
+error = 3   # Raise Queue.Full
+
+
+class BoundedQueue(Queue.Queue):
+    """
+    A thread-safe FIFO queue with a maximum size and a policy for what happens when it is full.
+
+    Parameters
+    ----------
+    maxsize: int
+        The maximum number of items in the queue.
+    overflow: int
+        One of block, drop and error.
+    """
+    def __init__(self, maxsize, overflow = block):
+        Queue.Queue.__init__(self, maxsize)
+        self.overflow = overflow
+        self.dropped = 0
+
+    """ Adds an item according to the overflow policy. Returns whether the item was added. """
+    def offer(self, item):
+        if self.overflow == block:
+            self.put(item)
+            return True
+        try:
+            self.put_nowait(item)
+            return True
+        except Queue.Full:
+            if self.overflow == error:
+                raise
+            self.dropped += 1
+            return False
+
+    """ Removes and returns up to max_items items without waiting """
+    def get_available(self, max_items):
+        items = []
+        while len(items) < max_items:
+            try:
+                items.append(self.get_nowait())
+            except Queue.Empty:
+                break
+        return items
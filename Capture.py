@@ -0,0 +1,123 @@
+"""
+Recording and replaying of the raw bytes received by a connection. A capture file starts with a magic
+string and is followed by one record per received chunk: the time of reception as a double, the length
+of the chunk as an unsigned int (both little endian) and the bytes of the chunk.
+
+To measure how fast a capture is decoded, run
+
+    python Capture.py capture.log [--realtime] [--framing stuffing|length|cobs]
+"""
+import mmap
+import os
+import struct
+from threading import Lock
+from time import time, sleep
+
+magic = "PBCAP1\n"
+
+_record_header = struct.Struct("<dI")
+
+
+class Recorder(object):
+    """
+    Appends received chunks with timestamps to a capture file.
+
+    Parameters
+    ----------
+
+    path: str
+        The capture file. If it exists, new records are appended to it.
+    flush: boolean
+        If True, the file is flushed after every record, so a crash loses nothing.
+    """
+    def __init__(self, path, flush = False):
+        self.path = path
+        self.flush = flush
+        self.lock = Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(magic)
+
+    """ Appends a chunk, received at time t (now if None). Chunks that arrive after close() are ignored,
+        since the receiving thread may still be recording while the connection stops recording. """
+    def record(self, data, t = None):
+        if t is None:
+            t = time()
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(_record_header.pack(t, len(data)))
+            self.file.write(data)
+            if self.flush:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+""" Yields a (timestamp, chunk) tuple for every record in a capture file. The file is memory-mapped,
+    so only the chunks themselves are copied. """
+def iter_records(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(magic):
+            return
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            if mm[:len(magic)] != magic:
+                raise ValueError(path + " is not a capture file")
+            pos = len(magic)
+            end = len(mm)
+            header_size = _record_header.size
+            while pos + header_size <= end:
+                t, length = _record_header.unpack_from(mm, pos)
+                pos += header_size
+                if pos + length > end:
+                    break   # Truncated by a crash while recording
+                yield t, mm[pos:pos + length]
+                pos += length
+        finally:
+            mm.close()
+
+
+""" Feeds the chunks of a capture file to callback, e.g. the data_callback or byte_callback of a
+    connection. If realtime is True, the recorded pauses between chunks are kept (divided by speed),
+    otherwise the chunks are fed as fast as possible. Returns a dict with the number of chunks and
+    bytes, the time it took and the resulting rate. """
+def replay(path, callback, realtime = False, speed = 1.):
+    chunks = 0
+    size = 0
+    first = None
+    start = time()
+    for t, data in iter_records(path):
+        if realtime:
+            if first is None:
+                first = t
+            delay = (t - first) / speed - (time() - start)
+            if delay > 0:
+                sleep(delay)
+        callback(data)
+        chunks += 1
+        size += len(data)
+    seconds = time() - start
+    return {"chunks": chunks, "bytes": size, "seconds": seconds,
+            "mb_per_second": size / seconds / 1e6 if seconds > 0 else None}
+
+
+if __name__=="__main__":
+    import argparse
+    from PacketConnection import FramedPacketConnection
+    from Framing import LengthPrefixFraming, CobsFraming
+
+    framings = {"stuffing": None, "length": LengthPrefixFraming, "cobs": CobsFraming}
+    parser = argparse.ArgumentParser(description = "Replays a capture file through the deframer")
+    parser.add_argument("path")
+    parser.add_argument("--realtime", action = "store_true", help = "Keep the recorded timing")
+    parser.add_argument("--framing", choices = sorted(framings), default = "stuffing")
+    args = parser.parse_args()
+
+    packets = []
+    conn = FramedPacketConnection(lambda pck: packets.append(len(pck.data)), framing = framings[args.framing])
+    result = replay(args.path, conn.data_callback, args.realtime)
+    print "%d chunks, %d bytes, %d packets in %.3fs (%.1f MB/s)" % (result["chunks"], result["bytes"], len(packets),
+                                                                   result["seconds"], result["mb_per_second"] or 0)
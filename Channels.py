@@ -0,0 +1,187 @@
+import Queue
+import struct
+from collections import deque
+from threading import Thread, Condition
+from BoundedQueue import block, drop, error
+from Packet import Packet
+
+def_quantum = 1024       # Bytes a channel of weight 1 may send per round
+def_max_queued = 256     # Frames waiting per channel
+
+# Channel number
+_header = struct.Struct("<B")
+
+D = False
+
+
+class Channel(object):
+    """
+    A logical channel of a ChannelMux. Is created with ChannelMux.open_channel().
+    """
+    def __init__(self, mux, number, callback, priority, weight):
+        self.mux = mux
+        self.number = number
+        self.callback = callback
+        self.priority = priority
+        self.weight = weight
+        self.queue = deque()   # Payloads waiting to be sent
+        self.deficit = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.dropped = 0
+
+    """ Sends a packet on this channel. Returns whether it was queued. """
+    def sendPacket(self, pck):
+        return self.mux.send(self, pck)
+
+    """ Returns the number of frames waiting to be sent on this channel """
+    def depth(self):
+        return len(self.queue)
+
+
+class ChannelMux(object):
+    """
+    Carries up to 256 numbered logical channels over one FramedPacketConnection. Every packet is prefixed
+    with its channel number and passed to the callback of its channel on the receiving side.
+
+    Outgoing frames are queued per channel and written by a scheduler thread. Channels with a higher
+    priority are always served first; channels of the same priority share the link by weight, using
+    deficit round robin over the frame sizes. To keep a large packet of a bulk channel from delaying an
+    urgent channel, enable fragmentation on the connection: the scheduler then interleaves the channels
+    fragment by fragment, so an urgent frame waits for at most one fragment. The connection should not use
+    a send queue, as it would send the frames in the order they were scheduled regardless of the channels.
+
+    The mux becomes the callback of the connection. Both sides of a connection need a ChannelMux.
+
+    Parameters
+    ----------
+
+    connection: FramedPacketConnection
+        The connection the channels are carried over.
+    quantum: int
+        The number of bytes a channel of weight 1 may send before the next channel of the same priority
+        gets its turn.
+    max_queued: int
+        The maximum number of frames waiting per channel.
+    overflow: int
+        What to do if the queue of a channel is full. One of BoundedQueue.block, BoundedQueue.drop and
+        BoundedQueue.error.
+    """
+    def __init__(self, connection, quantum = def_quantum, max_queued = def_max_queued, overflow = block):
+        self.connection = connection
+        self.quantum = quantum
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.channels = {}      # number -> Channel
+        self.ring = deque()     # Channels in round robin order
+        self.condition = Condition()
+        self.queued = 0
+        self.invalid = 0        # Received packets for unknown channels
+        self.running = True
+        connection.set_callback(self.packet_received)
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Opens a channel. Its received packets are passed to callback. Channels with a higher priority are
+        sent first; weight sets the share of the link among channels of the same priority. """
+    def open_channel(self, number, callback, priority = 0, weight = 1):
+        if not 0 <= number <= 255:
+            raise ValueError("Channel numbers range from 0 to 255")
+        if weight <= 0:
+            raise ValueError("The weight of a channel has to be positive")
+        with self.condition:
+            if number in self.channels:
+                raise ValueError("Channel %d is already open" % number)
+            channel = Channel(self, number, callback, priority, weight)
+            self.channels[number] = channel
+            self.ring.append(channel)
+        return channel
+
+    """ Closes a channel. Frames that are still queued on it are discarded. """
+    def close_channel(self, number):
+        with self.condition:
+            channel = self.channels.pop(number)
+            self.ring.remove(channel)
+            self.queued -= len(channel.queue)
+            channel.queue.clear()
+            self.condition.notify_all()
+
+    """ Queues a packet on a channel. Should only be used internally, see Channel.sendPacket(). """
+    def send(self, channel, pck):
+        out = Packet()
+        out.put_data(_header.pack(channel.number) + str(pck.get_data()))
+        payloads = self.connection.payloads(out)
+        with self.condition:
+            while len(channel.queue) + len(payloads) > self.max_queued and channel.queue:
+                if self.overflow == error:
+                    raise Queue.Full
+                if self.overflow == drop:
+                    channel.dropped += 1
+                    return False
+                self.condition.wait()
+            if self.channels.get(channel.number) is not channel:
+                raise ValueError("Channel %d is closed" % channel.number)
+            channel.queue.extend(payloads)
+            self.queued += len(payloads)
+            self.condition.notify_all()
+        return True
+
+    """ Returns the number of frames waiting to be sent on all channels """
+    def depth(self):
+        return self.queued
+
+    """ Stops the scheduler thread. Frames that are still queued are discarded. """
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+    """ The callback of the connection. Should only be used internally. """
+    def packet_received(self, pck):
+        data = str(pck.get_data())
+        channel = self.channels.get(ord(data[0])) if data else None
+        if channel is None:
+            self.invalid += 1
+            if self.connection.hooks:
+                self.connection.report_dropped(1, "unknown channel")
+            return
+        pck.put_data(data[_header.size:])
+        pck.position = 0
+        channel.received += 1
+        channel.callback(pck)
+
+    """ Returns the next payload to send, or None if there is none. Is called with the condition held. """
+    def next_payload(self):
+        if not self.queued:
+            return None
+        priority = max(channel.priority for channel in self.ring if channel.queue)
+        while True:
+            channel = self.ring[0]
+            if channel.queue and channel.priority == priority:
+                size = len(channel.queue[0])
+                if channel.deficit >= size:
+                    channel.deficit -= size
+                    payload = channel.queue.popleft()
+                    if not channel.queue:
+                        channel.deficit = 0
+                    channel.sent_frames += 1
+                    channel.sent_bytes += size
+                    self.queued -= 1
+                    return payload
+                channel.deficit += self.quantum * channel.weight
+            self.ring.rotate(-1)
+
+    def run(self):
+        while True:
+            with self.condition:
+                payload = self.next_payload()
+                while payload is None and self.running:
+                    self.condition.wait()
+                    payload = self.next_payload()
+                if not self.running:
+                    return
+                self.condition.notify_all()   # There is room in a channel queue
+            self.connection.sendPayload(payload)
@@ -0,0 +1,76 @@
+import zlib
+
+def_threshold = 128
+def_level = 6
+def_max_size = 1 << 22   # Largest payload a received frame may decompress to
+
+# Flags in front of every payload
+flag_raw = '\x00'
+flag_zlib = '\x01'
+
+
+class Compressor(object):
+    """
+    Compresses the payloads of a connection with zlib. Every payload is prefixed with a flag byte
+    that tells whether it is compressed, so compressed and uncompressed frames can be mixed freely:
+    payloads smaller than threshold, and payloads that zlib cannot shrink, are sent as they are.
+    The receiving side only looks at the flags, so both sides may use different thresholds and levels,
+    but both have to enable compression.
+
+    Parameters
+    ----------
+
+    threshold: int
+        Payloads with fewer bytes are never compressed.
+    level: int
+        The zlib compression level from 1 (fastest) to 9 (smallest).
+    max_size: int
+        Received payloads that decompress to more bytes are rejected as invalid, so that a small frame
+        from the peer cannot expand into a huge one.
+    """
+    def __init__(self, threshold = def_threshold, level = def_level, max_size = def_max_size):
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+        self.compressed = 0     # Number of payloads sent compressed
+        self.bytes_saved = 0
+        self.invalid = 0        # Received payloads that could not be decompressed
+
+    """ Returns the flagged, possibly compressed payload """
+    def compress(self, data):
+        if len(data) >= self.threshold:
+            packed = zlib.compress(data, self.level)
+            if len(packed) < len(data):
+                self.compressed += 1
+                self.bytes_saved += len(data) - len(packed)
+                return flag_zlib + packed
+        return flag_raw + data
+
+    """ Reverts compress(). Returns None if the payload is invalid or decompresses to more than max_size bytes. """
+    def decompress(self, data):
+        flag = data[:1]
+        if flag == flag_raw:
+            return data[1:]
+        if flag == flag_zlib:
+            try:
+                decompressor = zlib.decompressobj()
+                # One byte more than allowed tells an oversized payload from one of exactly max_size bytes.
+                # The byte appended to the input ends up in unused_data only if the zlib stream was complete.
+                unpacked = decompressor.decompress(data[1:] + "\x00", self.max_size + 1)
+                if len(unpacked) <= self.max_size and decompressor.unused_data:
+                    return unpacked
+            except zlib.error:
+                pass
+        self.invalid += 1
+        return None
+
+    """ Decompresses the payloads of a list of received packets. Returns the packets that were valid. """
+    def decompress_packets(self, packets):
+        valid = []
+        for pck in packets:
+            data = self.decompress(str(pck.get_data()))
+            if data is not None:
+                pck.put_data(data)
+                valid.append(pck)
+        return valid
+
@@ -0,0 +1,237 @@
+import json
+import os
+from threading import Thread, Condition
+from time import time
+
+def_ttl = 300.           # Seconds a discovery result is used without a new scan
+def_duration = 8         # Length of an inquiry scan in units of 1.28 seconds, as for discover_devices()
+
+D = False
+
+
+""" Runs an inquiry scan with PyBluez. PyBluez is imported here so that a cache can be used without it,
+    e.g. with a stub or only with the address book. """
+def _discover_devices(duration):
+    from bluetooth import discover_devices
+    return discover_devices(duration = duration)
+
+
+class DeviceCache(object):
+    """
+    Caches the addresses found by Bluetooth device discovery. An inquiry scan takes ten seconds or more,
+    so a connection should not have to wait for one whenever it is opened or reopened.
+
+    devices() answers from the cache as long as the last scan is younger than ttl seconds. Once it is
+    older, the cached addresses are still returned if background refreshing is enabled, and a new scan
+    is started on a separate thread; otherwise the caller waits for a new scan. Concurrent callers share
+    a single scan.
+
+    If path is given, the peers a connection was opened to are kept in an address book in that file
+    (see remember()). They are returned before the discovered devices, the most recently connected first,
+    so a client reconnects to its last peer without scanning at all. The address book survives restarts.
+
+    Parameters
+    ----------
+
+    ttl: float
+        The time in seconds a scan result is considered fresh.
+    path: string
+        The file of the address book, or None to keep known peers only in memory.
+    discover: function
+        Runs a scan. Is called with duration and returns a list of addresses. Defaults to
+        bluetooth.discover_devices.
+    duration: int
+        Passed to discover, in units of 1.28 seconds.
+    background: boolean
+        Whether stale results are returned while a new scan runs in the background.
+    """
+    def __init__(self, ttl = def_ttl, path = None, discover = None, duration = def_duration, background = True):
+        self.ttl = ttl
+        self.path = path
+        self.discover = discover or _discover_devices
+        self.duration = duration
+        self.background = background
+        self.condition = Condition()
+        self.discovered = []      # Addresses of the last scan
+        self.scanned_at = None    # Time the last scan finished
+        self.known = {}           # address -> time of the last connection
+        self.scanning = False
+        self.error = None         # Exception of the last failed scan
+        self.thread = None
+        self.refresh_interval = None
+        self.running = False
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.scans = 0
+        self.failed_scans = 0
+        self.scan_time = 0.
+        if path is not None:
+            self.load()
+
+    """ Returns whether the last scan is younger than ttl """
+    def fresh(self):
+        return self.scanned_at is not None and time() - self.scanned_at < self.ttl
+
+    """ Returns the known and discovered addresses. Scans if the cache is stale and cannot be used. """
+    def devices(self):
+        with self.condition:
+            if self.fresh():
+                self.hits += 1
+                return self.addresses()
+            cached = self.addresses()
+            if cached and self.background:
+                self.stale_hits += 1
+                self.start_scan()
+                return cached
+            self.misses += 1
+            if not self.scanning:
+                self.start_scan(wait = True)
+            while self.scanning:
+                self.condition.wait()
+            if self.error is not None and not self.fresh():
+                raise self.error
+            return self.addresses()
+
+    """ Returns the first address of devices(). Raises an IndexError if no device was found. """
+    def first(self):
+        devices = self.devices()
+        if not devices:
+            raise IndexError("No bluetooth device found")
+        return devices[0]
+
+    """ Returns the cached addresses without scanning. Is called with the condition held. """
+    def addresses(self):
+        known = sorted(self.known, key = self.known.get, reverse = True)
+        return known + [address for address in self.discovered if address not in self.known]
+
+    """ Starts a scan unless one is running. With wait, the scan runs on the calling thread. Is called
+        with the condition held. """
+    def start_scan(self, wait = False):
+        if self.scanning:
+            return
+        self.scanning = True
+        if wait:
+            self.condition.release()
+            try:
+                self.scan()
+            finally:
+                self.condition.acquire()
+        else:
+            thread = Thread(target = self.scan)
+            thread.daemon = True
+            thread.start()
+
+    """ Runs a scan and stores its result. Should only be used internally. """
+    def scan(self):
+        start = time()
+        try:
+            if D: print "Searching for bluetooth devices.."
+            found = list(self.discover(self.duration))
+            error = None
+        except Exception, e:
+            found = None
+            error = e
+        with self.condition:
+            self.scans += 1
+            self.scan_time += time() - start
+            if error is None:
+                self.discovered = found
+                self.scanned_at = time()
+                if D: print "Found %d bluetooth devices" % len(found)
+            else:
+                self.failed_scans += 1
+                if D: print "Device discovery failed: " + str(error)
+            self.error = error
+            self.scanning = False
+            self.condition.notify_all()
+
+    """ Scans now, even if the cache is fresh, and returns the addresses """
+    def refresh(self):
+        with self.condition:
+            self.start_scan(wait = not self.scanning)
+            while self.scanning:
+                self.condition.wait()
+            return self.addresses()
+
+    """ Scans every interval seconds on a background thread, so that devices() never has to wait. The
+        interval defaults to half the ttl. """
+    def start_refreshing(self, interval = None):
+        with self.condition:
+            self.refresh_interval = interval if interval is not None else self.ttl / 2.
+            if self.running:
+                return
+            self.running = True
+            self.thread = Thread(target = self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    """ Stops the background refreshing started by start_refreshing() """
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                if not self.scanning:
+                    self.start_scan(wait = True)
+                deadline = time() + self.refresh_interval
+                while self.running and (self.scanning or time() < deadline):
+                    self.condition.wait(max(0., deadline - time()) if not self.scanning else None)
+
+    """ Adds an address to the address book, e.g. after a connection to it was opened """
+    def remember(self, address):
+        with self.condition:
+            self.known[address] = time()
+        if self.path is not None:
+            self.save()
+
+    """ Removes an address from the address book and from the discovered devices """
+    def forget(self, address):
+        with self.condition:
+            self.known.pop(address, None)
+            if address in self.discovered:
+                self.discovered = [a for a in self.discovered if a != address]
+        if self.path is not None:
+            self.save()
+
+    """ Reads the address book from path. A missing file is an empty address book. """
+    def load(self):
+        try:
+            with open(self.path) as f:
+                peers = json.load(f)
+        except IOError:
+            return
+        with self.condition:
+            for address, last_connected in peers.items():
+                self.known[str(address)] = max(last_connected, self.known.get(address, 0))
+
+    """ Writes the address book to path. The file is replaced at once, so it is never half written. """
+    def save(self):
+        with self.condition:
+            text = json.dumps(self.known, indent = 2, sort_keys = True)
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            f.write(text)
+        os.rename(temp, self.path)
+
+    """ Returns the hits and misses of the cache and the number and duration of scans """
+    def metrics(self):
+        with self.condition:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {"hits": self.hits,
+                    "stale_hits": self.stale_hits,
+                    "misses": self.misses,
+                    "hit_rate": (self.hits + self.stale_hits) / float(lookups) if lookups else 0.,
+                    "scans": self.scans,
+                    "failed_scans": self.failed_scans,
+                    "mean_scan_time": self.scan_time / self.scans if self.scans else 0.,
+                    "known_devices": len(self.known),
+                    "discovered_devices": len(self.discovered)}
@@ -0,0 +1,112 @@
+import traceback
+from threading import Thread, Lock
+from time import time
+from BoundedQueue import BoundedQueue, block
+
+def_workers = 4
+def_max_queued = 1024
+
+_stop = object()
+
+
+class PacketDispatcher(object):
+    """
+    Runs packet callbacks on a pool of worker threads, so that the thread reading from the socket
+    only has to parse packets and never waits for the application.
+
+    In ordered mode, all packets submitted with the same key (e.g. the same connection) are handled
+    by the same worker, one after the other and in the order they arrived. In unordered mode, any
+    idle worker takes the next packet.
+
+    Parameters
+    ----------
+    workers: int
+        The number of worker threads.
+    max_queued: int
+        The maximum number of packets waiting per queue (one queue per worker in ordered mode,
+        one shared queue otherwise).
+    overflow: int
+        What to do if a queue is full. One of BoundedQueue.block, BoundedQueue.drop and BoundedQueue.error.
+    ordered: boolean
+        Defines whether packets with the same key are handled in order.
+    """
+    def __init__(self, workers = def_workers, max_queued = def_max_queued, overflow = block, ordered = True):
+        self.ordered = ordered
+        if ordered:
+            self.queues = [BoundedQueue(max_queued, overflow) for _ in range(workers)]
+        else:
+            self.queues = [BoundedQueue(max_queued, overflow)]
+        self.lock = Lock()
+        self.handled = 0
+        self.failed = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+        self.total_handler_time = 0.
+        self.max_handler_time = 0.
+        self.threads = []
+        for i in range(workers):
+            thread = Thread(target = self.run, args = (self.queues[i % len(self.queues)],))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    """ Queues a packet to be passed to handler. Returns whether the packet was accepted. """
+    def submit(self, key, handler, pck):
+        if self.ordered:
+            queue = self.queues[hash(key) % len(self.queues)]
+        else:
+            queue = self.queues[0]
+        return queue.offer((handler, pck, time()))
+
+    """ Returns the number of packets waiting to be handled """
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    """ Returns a dict with the number of handled and dropped packets and the time packets spent waiting
+        in the queue and in their handler """
+    def metrics(self):
+        with self.lock:
+            handled = max(self.handled, 1)
+            return {"handled": self.handled,
+                    "failed": self.failed,
+                    "dropped": sum(queue.dropped for queue in self.queues),
+                    "queued": self.depth(),
+                    "mean_wait": self.total_wait / handled,
+                    "max_wait": self.max_wait,
+                    "mean_handler_time": self.total_handler_time / handled,
+                    "max_handler_time": self.max_handler_time}
+
+    """ Stops the workers after the packets that are already queued were handled """
+    def stop(self):
+        for i in range(len(self.threads)):
+            self.queues[i % len(self.queues)].put(_stop)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self, queue):
+        while True:
+            item = queue.get()
+            if item is _stop:
+                return
+            handler, pck, queued_at = item
+            started = time()
+            failed = False
+            try:
+                handler(pck)
+            except Exception:
+                failed = True
+                traceback.print_exc()
+            finished = time()
+            wait = started - queued_at
+            handler_time = finished - started
+            with self.lock:
+                self.handled += 1
+                if failed:
+                    self.failed += 1
+                self.total_wait += wait
+                self.total_handler_time += handler_time
+                if wait > self.max_wait:
+                    self.max_wait = wait
+                if handler_time > self.max_handler_time:
+                    self.max_handler_time = handler_time
@@ -0,0 +1,140 @@
+import struct
+from collections import OrderedDict
+from threading import Lock
+from Packet import Packet
+
+def_max_packet_size = 232
+def_max_pending = 64
+def_max_pending_bytes = 1 << 22
+
+# Message id, fragment index, number of fragments
+_header = struct.Struct("<HHH")
+
+
+class Fragmenter(object):
+    """
+    Splits payloads into fragments of at most max_packet_size bytes, including a header with the id of
+    the message, the index of the fragment and the number of fragments of the message. Every payload is
+    given a header, also if it fits into a single fragment.
+
+    Parameters
+    ----------
+
+    max_packet_size: int
+        The maximum size of a fragment including its header.
+    """
+    def __init__(self, max_packet_size = def_max_packet_size):
+        if max_packet_size <= _header.size:
+            raise ValueError("max_packet_size has to be larger than the fragment header")
+        self.chunk_size = max_packet_size - _header.size
+        self.next_id = 0
+        self.lock = Lock()
+
+    """ Returns the list of fragments for a payload """
+    def split(self, data):
+        count = max(1, (len(data) + self.chunk_size - 1) // self.chunk_size)
+        if count > 0xffff:
+            raise ValueError("Payload of %d bytes needs too many fragments" % len(data))
+        with self.lock:
+            message_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xffff
+        return [_header.pack(message_id, i, count) + data[i * self.chunk_size:(i + 1) * self.chunk_size]
+                for i in xrange(count)]
+
+
+class Reassembler(object):
+    """
+    Collects fragments created by a Fragmenter and puts the messages back together. Fragments of
+    different messages may arrive interleaved. To bound the memory, at most max_pending incomplete
+    messages and max_pending_bytes bytes are kept; if there are more, the oldest incomplete messages
+    are discarded.
+
+    Parameters
+    ----------
+
+    max_pending: int
+        The maximum number of incomplete messages.
+    max_pending_bytes: int
+        The maximum number of bytes held by incomplete messages.
+    """
+    def __init__(self, max_pending = def_max_pending, max_pending_bytes = def_max_pending_bytes):
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = OrderedDict()   # message id -> _Message
+        self.pending_bytes = 0
+        self.discarded = 0   # Incomplete messages that were given up on
+        self.invalid = 0     # Fragments that could not be used
+
+    """ Takes a list of received fragments and returns the list of completed messages as packets """
+    def reassemble(self, packets):
+        complete = []
+        for pck in packets:
+            pck = self.add(pck)
+            if pck is not None:
+                complete.append(pck)
+        return complete
+
+    """ Adds a received fragment. Returns the message as a packet if it is complete now, else None. """
+    def add(self, pck):
+        data = str(pck.get_data())
+        if len(data) < _header.size:
+            self.invalid += 1
+            return None
+        message_id, index, count = _header.unpack_from(data)
+        if index >= count:
+            self.invalid += 1
+            return None
+
+        if count == 1:
+            pck.put_data(data[_header.size:])
+            return pck
+
+        message = self.pending.get(message_id)
+        if message is None or message.count != count:
+            if message is not None:
+                self._discard(message_id)
+            message = _Message(count, pck.start_time)
+            self.pending[message_id] = message
+        if message.parts[index] is not None:
+            self.invalid += 1
+            return None
+        message.parts[index] = data[_header.size:]
+        pck.release()
+        message.received += 1
+        self.pending_bytes += len(data) - _header.size
+        message.size += len(data) - _header.size
+
+        if message.received == count:
+            del self.pending[message_id]
+            self.pending_bytes -= message.size
+            result = Packet()
+            result.put_data("".join(message.parts))
+            result.set_start_time(message.start_time)
+            result.set_end_time(pck.end_time)
+            return result
+
+        while self.pending and (len(self.pending) > self.max_pending or self.pending_bytes > self.max_pending_bytes):
+            self._discard(next(iter(self.pending)))
+        return None
+
+    """ Discards all incomplete messages. Returns whether there were any. """
+    def reset(self):
+        partial = len(self.pending) > 0
+        self.pending.clear()
+        self.pending_bytes = 0
+        return partial
+
+    def _discard(self, message_id):
+        message = self.pending.pop(message_id)
+        self.pending_bytes -= message.size
+        self.discarded += 1
+
+
+class _Message(object):
+    """ The fragments of a message received so far """
+    def __init__(self, count, start_time):
+        self.count = count
+        self.parts = [None] * count
+        self.received = 0
+        self.size = 0
+        self.start_time = start_time
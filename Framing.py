@@ -0,0 +1,330 @@
+import re
+import struct
+from time import time
+from Packet import received_packet
+
+def_start_byte = '\xfc'
+def_end_byte = '\xfd'
+def_escape_byte = '\xfe'
+def_octet_stuff_byte = '\x20'
+def_max_frame_size = 1 << 24
+
+# Deframer states
+ready = 3
+incoming = 4
+escaping = 5
+
+
+class ByteStuffingFraming(object):
+    """
+    Splits a byte stream into packets that are framed by start and end bytes. Bytes inside a frame
+    that equal one of the control bytes are preceded by the escape byte and xor'ed with the octet
+    stuffing byte.
+
+    In contrast to parsing the stream byte by byte, this class takes whole chunks as they are returned
+    by recv() and searches them for control bytes in bulk. The state of a partially received frame
+    is kept between chunks. Likewise, the encoder escapes a whole payload with string replacements.
+
+    Parameters
+    ----------
+
+    start_byte: byte
+       The start byte of a packet (default: '\xfc')
+    end_byte: byte
+       The end byte of a packet (default: '\xfd')
+    escape_byte: byte
+       The escape character. (default: '\xfe')
+    octet_stuff_byte: byte
+       The byte used to do octet stuffing and unstuffing on escaped characters.
+    """
+    def __init__(self, start_byte = def_start_byte, end_byte = def_end_byte, escape_byte = def_escape_byte,
+                 octet_stuff_byte = def_octet_stuff_byte):
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.escape_byte = escape_byte
+        self.octet_stuff_byte = octet_stuff_byte
+        # Matches the longest run of payload bytes and escaped pairs, i.e. everything up to the end byte
+        others = "[^" + re.escape(escape_byte) + re.escape(end_byte) + "]*"
+        self._body = re.compile(others + "(?:" + re.escape(escape_byte) + "." + others + ")*", re.DOTALL)
+        self._escaped_pair = re.compile(re.escape(escape_byte) + "(.)", re.DOTALL)
+        self._unstuff = dict((chr(i), chr(i ^ ord(octet_stuff_byte))) for i in range(256))
+        specials = (escape_byte, start_byte, end_byte)
+        self._needs_escaping = re.compile("[" + "".join(re.escape(b) for b in specials) + "]")
+        self._stuffed = dict((b, escape_byte + self._unstuff[b]) for b in specials)
+        # Escaping with chained replacements is only correct if no stuffed byte is a control byte itself.
+        # The escape byte is replaced first, so the escape bytes inserted afterwards are left alone.
+        self._replace_in_order = not any(self._unstuff[b] in specials for b in specials)
+        self.state = ready
+        self.chunks = []
+        self.start_time = 0
+        self.pool = None   # PacketPool for the received packets
+
+    """ Discards a partially received frame. Returns whether there was one. """
+    def reset(self):
+        partial = self.state != ready
+        self.state = ready
+        self.chunks = []
+        self.start_time = 0
+        return partial
+
+    """ Parses a chunk of received bytes. Returns a list of all packets that were completed by it. """
+    def feed(self, data):
+        packets = []
+        pos = 0
+        n = len(data)
+        now = time()
+        while pos < n:
+            if self.state == ready:
+                # Everything outside of a frame is skipped
+                idx = data.find(self.start_byte, pos)
+                if idx < 0:
+                    break
+                self.start_time = now
+                self.state = incoming
+                pos = idx + 1
+
+            elif self.state == incoming:
+                idx = self._body.match(data, pos).end()
+                if idx > pos:
+                    self.chunks.append(self.unescape(data[pos:idx]))
+                if idx == n:
+                    break
+                if data[idx] == self.end_byte:
+                    packets.append(self._finish(now))
+                else:
+                    # The chunk ends right after an escape byte
+                    self.state = escaping
+                pos = idx + 1
+
+            else:
+                self.chunks.append(self._unstuff[data[pos]])
+                self.state = incoming
+                pos += 1
+        return packets
+
+    """ Reverts the escaping of a part of a frame that ends with a complete escaped pair or payload byte """
+    def unescape(self, data):
+        if self.escape_byte not in data:
+            return data
+        if self._replace_in_order:
+            # If all escaped bytes are control bytes, the pairs can be replaced one kind at a time
+            pairs = sum(data.count(self._stuffed[b]) for b in (self.start_byte, self.end_byte, self.escape_byte))
+            if pairs == data.count(self.escape_byte):
+                for b in (self.start_byte, self.end_byte, self.escape_byte):
+                    data = data.replace(self._stuffed[b], b)
+                return data
+        return self._escaped_pair.sub(lambda m: self._unstuff[m.group(1)], data)
+    
+    """ Returns the payload with all control bytes escaped """
+    def escape(self, data):
+        if self._needs_escaping.search(data) is None:
+            return data
+        if self._replace_in_order:
+            for b in (self.escape_byte, self.start_byte, self.end_byte):
+                data = data.replace(b, self._stuffed[b])
+            return data
+        return self._needs_escaping.sub(lambda m: self._stuffed[m.group()], data)
+    
+    """ Returns the frame for the given payload """
+    def encode(self, data):
+        return self.start_byte + self.escape(data) + self.end_byte
+    
+    """ Appends the frame for the given payload to the bytearray buf """
+    def encode_into(self, buf, data):
+        buf += self.start_byte
+        buf += self.escape(data)
+        buf += self.end_byte
+
+    def _finish(self, now):
+        chunks = self.chunks
+        pck = received_packet(chunks[0] if len(chunks) == 1 else "".join(chunks), self.start_time, now, self.pool)
+        self.state = ready
+        self.chunks = []
+        return pck
+
+
+class Unframed(object):
+    """
+    Treats every received byte as a packet of its own. Sent payloads are still framed and escaped with the
+    given bytes, as unframed connections always did.
+    """
+    def __init__(self, start_byte = def_start_byte, end_byte = def_end_byte, escape_byte = def_escape_byte,
+                 octet_stuff_byte = def_octet_stuff_byte):
+        self.encoder = ByteStuffingFraming(start_byte, end_byte, escape_byte, octet_stuff_byte)
+        self.pool = None   # PacketPool for the received packets
+
+    def reset(self):
+        return False
+
+    """ Parses a chunk of received bytes. Returns one packet per byte. """
+    def feed(self, data):
+        packets = []
+        t = time()
+        pool = self.pool
+        for dat in data:
+            packets.append(received_packet(dat, t, t, pool))
+        return packets
+    
+    """ Returns the frame for the given payload """
+    def encode(self, data):
+        return self.encoder.encode(data)
+    
+    """ Appends the frame for the given payload to the bytearray buf """
+    def encode_into(self, buf, data):
+        self.encoder.encode_into(buf, data)
+
+
+class LengthPrefixFraming(object):
+    """
+    Frames every packet with a 4-byte header holding the length of the payload. The overhead is
+    constant and the payload is never scanned, but a corrupted header cannot be recovered from.
+
+    Parameters
+    ----------
+
+    max_frame_size: int
+       Frames announcing a larger payload are treated as a corrupted stream, which is then discarded.
+    littleendian: boolean
+       Defines the byte order of the length header.
+    """
+    def __init__(self, max_frame_size = def_max_frame_size, littleendian = True):
+        self.max_frame_size = max_frame_size
+        if littleendian:
+            self.header = struct.Struct("<I")
+        else:
+            self.header = struct.Struct(">I")
+        self.buffer = bytearray()
+        self.start_time = 0
+        self.corrupted = 0   # Number of times the stream was discarded because of an invalid header
+        self.pool = None     # PacketPool for the received packets
+
+    """ Discards a partially received frame. Returns whether there was one. """
+    def reset(self):
+        partial = len(self.buffer) > 0
+        self.buffer = bytearray()
+        return partial
+
+    """ Parses a chunk of received bytes. Returns a list of all packets that were completed by it. """
+    def feed(self, data):
+        now = time()
+        if not self.buffer:
+            self.start_time = now
+        buf = self.buffer
+        buf += data
+        packets = []
+        pos = 0
+        n = len(buf)
+        header_size = self.header.size
+        while n - pos >= header_size:
+            length = self.header.unpack_from(buf, pos)[0]
+            if length > self.max_frame_size:
+                self.corrupted += 1
+                pos = n
+                break
+            end = pos + header_size + length
+            if end > n:
+                break
+            packets.append(received_packet(str(buf[pos + header_size:end]), self.start_time, now, self.pool))
+            pos = end
+            self.start_time = now
+        del buf[:pos]
+        return packets
+
+    """ Returns the frame for the given payload """
+    def encode(self, data):
+        return self.header.pack(len(data)) + data
+
+    """ Appends the frame for the given payload to the bytearray buf """
+    def encode_into(self, buf, data):
+        buf += self.header.pack(len(data))
+        buf += data
+
+
+""" Encodes data with Consistent Overhead Byte Stuffing, so that the result contains no zero bytes """
+def cobs_encode(data):
+    out = []
+    for block in data.split("\x00"):
+        while len(block) >= 254:
+            out.append("\xff")
+            out.append(block[:254])
+            block = block[254:]
+        out.append(chr(len(block) + 1))
+        out.append(block)
+    return "".join(out)
+
+
+""" Reverts cobs_encode. Returns None if data is not a valid encoding. """
+def cobs_decode(data):
+    out = []
+    pos = 0
+    n = len(data)
+    while pos < n:
+        code = ord(data[pos])
+        end = pos + code
+        if code == 0 or end > n:
+            return None
+        out.append(data[pos + 1:end])
+        pos = end
+        if code < 0xff and pos < n:
+            out.append("\x00")
+    return "".join(out)
+
+
+class CobsFraming(object):
+    """
+    Frames every packet with Consistent Overhead Byte Stuffing (COBS): the payload is encoded without
+    zero bytes and each frame is terminated by a zero byte. In contrast to escaping, the overhead is at
+    most one byte per 254 payload bytes, no matter what the payload contains, and the decoder works on
+    blocks of up to 254 bytes instead of single bytes. After corrupted data, the stream resynchronizes
+    at the next zero byte.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.start_time = 0
+        self.corrupted = 0   # Number of frames that could not be decoded
+        self.pool = None     # PacketPool for the received packets
+
+    """ Discards a partially received frame. Returns whether there was one. """
+    def reset(self):
+        partial = len(self.chunks) > 0
+        self.chunks = []
+        return partial
+
+    """ Parses a chunk of received bytes. Returns a list of all packets that were completed by it. """
+    def feed(self, data):
+        packets = []
+        pos = 0
+        now = time()
+        while True:
+            idx = data.find("\x00", pos)
+            if idx < 0:
+                if pos < len(data):
+                    if not self.chunks:
+                        self.start_time = now
+                    self.chunks.append(data[pos:])
+                return packets
+            if self.chunks:
+                self.chunks.append(data[pos:idx])
+                frame = "".join(self.chunks)
+                self.chunks = []
+                start_time = self.start_time
+            else:
+                frame = data[pos:idx]
+                start_time = now
+            pos = idx + 1
+            if not frame:
+                continue
+            payload = cobs_decode(frame)
+            if payload is None:
+                self.corrupted += 1
+                continue
+            packets.append(received_packet(payload, start_time, now, self.pool))
+
+    """ Returns the frame for the given payload """
+    def encode(self, data):
+        return cobs_encode(data) + "\x00"
+
+    """ Appends the frame for the given payload to the bytearray buf """
+    def encode_into(self, buf, data):
+        buf += cobs_encode(data)
+        buf += "\x00"
@@ -0,0 +1,157 @@
+import math
+from threading import Lock
+
+def_min_latency = 1e-6   # Upper bound of the first histogram bucket in seconds
+def_buckets = 32
+
+
+class ConnectionHook(object):
+    """
+    Receives events from a FramedPacketConnection. Subclasses override the methods they are
+    interested in; all methods do nothing by default. Hooks are attached with
+    FramedPacketConnection.add_hook(). As long as no hook is attached, a connection does not
+    collect any of these events.
+
+    The methods are called from the thread that caused the event, e.g. the receiving thread
+    for received frames.
+    """
+    """ A chunk of n bytes was read from the socket """
+    def bytes_received(self, conn, n):
+        pass
+
+    """ A complete packet was parsed from the stream. frame_size is not known for received frames """
+    def frame_received(self, conn, pck):
+        pass
+
+    """ n bytes were written to the socket """
+    def bytes_sent(self, conn, n):
+        pass
+
+    """ A packet with payload_size bytes was framed into frame_size bytes to be sent """
+    def frame_sent(self, conn, payload_size, frame_size):
+        pass
+
+    """ count frames were lost. reason is a short string, e.g. "partial" or "not ready" """
+    def frames_dropped(self, conn, count, reason):
+        pass
+
+    """ The connection was reopened after it had been lost """
+    def reconnected(self, conn):
+        pass
+
+    """ The callback took the given number of seconds to handle a packet """
+    def callback_finished(self, conn, pck, seconds):
+        pass
+
+
+class LatencyHistogram(object):
+    """
+    Counts durations in logarithmic buckets. Bucket i holds the durations between
+    min_latency * 2**(i-1) and min_latency * 2**i seconds; the last bucket also holds everything above.
+    """
+    def __init__(self, min_latency = def_min_latency, buckets = def_buckets):
+        self.min_latency = min_latency
+        self.counts = [0] * buckets
+        self.total = 0
+        self.sum = 0.
+
+    def add(self, seconds):
+        if seconds <= self.min_latency:
+            idx = 0
+        else:
+            idx = min(len(self.counts) - 1, int(math.ceil(math.log(seconds / self.min_latency, 2))))
+        self.counts[idx] += 1
+        self.total += 1
+        self.sum += seconds
+
+    """ Returns the upper bound of the bucket that contains the p-th percentile """
+    def percentile(self, p):
+        if self.total == 0:
+            return None
+        rank = p / 100. * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return self.min_latency * 2 ** i
+        return self.min_latency * 2 ** (len(self.counts) - 1)
+
+    def mean(self):
+        if self.total == 0:
+            return None
+        return self.sum / self.total
+
+
+class ConnectionStats(ConnectionHook):
+    """
+    A hook that counts the traffic of the connections it is attached to. The time between the first
+    and the last byte of each received frame is collected in a LatencyHistogram.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.payload_in = 0
+        self.payload_out = 0
+        self.framed_out = 0
+        self.dropped = {}
+        self.reconnects = 0
+        self.callback_time = 0.
+        self.assembly_latency = LatencyHistogram()
+
+    def bytes_received(self, conn, n):
+        with self.lock:
+            self.bytes_in += n
+
+    def frame_received(self, conn, pck):
+        with self.lock:
+            self.frames_in += 1
+            self.payload_in += len(pck.data)
+            self.assembly_latency.add(pck.end_time - pck.start_time)
+
+    def bytes_sent(self, conn, n):
+        with self.lock:
+            self.bytes_out += n
+
+    def frame_sent(self, conn, payload_size, frame_size):
+        with self.lock:
+            self.frames_out += 1
+            self.payload_out += payload_size
+            self.framed_out += frame_size
+
+    def frames_dropped(self, conn, count, reason):
+        with self.lock:
+            self.dropped[reason] = self.dropped.get(reason, 0) + count
+
+    def reconnected(self, conn):
+        with self.lock:
+            self.reconnects += 1
+
+    def callback_finished(self, conn, pck, seconds):
+        with self.lock:
+            self.callback_time += seconds
+
+    """ Returns the ratio of framed bytes to payload bytes of the sent frames """
+    def escape_ratio(self):
+        if self.payload_out == 0:
+            return None
+        return float(self.framed_out) / self.payload_out
+
+    """ Returns all counters as a dict """
+    def snapshot(self):
+        with self.lock:
+            return {"bytes_in": self.bytes_in,
+                    "bytes_out": self.bytes_out,
+                    "frames_in": self.frames_in,
+                    "frames_out": self.frames_out,
+                    "payload_in": self.payload_in,
+                    "payload_out": self.payload_out,
+                    "escape_ratio": self.escape_ratio(),
+                    "dropped": dict(self.dropped),
+                    "reconnects": self.reconnects,
+                    "callback_time": self.callback_time,
+                    "assembly_latency_mean": self.assembly_latency.mean(),
+                    "assembly_latency_p50": self.assembly_latency.percentile(50),
+                    "assembly_latency_p99": self.assembly_latency.percentile(99)}
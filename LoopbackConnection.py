@@ -0,0 +1,230 @@
+import math
+import random
+import threading
+from collections import deque
+from threading import Thread, Lock, Condition
+from time import time, sleep
+from PacketConnection import FramedPacketConnection
+
+def_start_byte = '\xfc'
+def_end_byte = '\xfd'
+def_escape_byte = '\xfe'
+def_octet_stuff_byte = '\x20'
+def_buffer_size = 1 << 20
+
+# States
+connected = 1
+disconnected = 2
+ready = 3
+dead = 7
+
+D = False
+
+
+class LoopbackConnection(FramedPacketConnection):
+    """
+    One end of an in-process connection. Both ends are created together by loopback_pair(). The bytes
+    written by one end are passed to data_callback() of the other end, so the whole protocol layer
+    (framing, fragmentation, compression, hooks) runs as on a socket, but without system calls.
+
+    Without latency and bandwidth limit, the bytes are delivered on the thread that sends them, before
+    sendPacket() returns. Packets sent from within a callback are delivered after the callback returned,
+    so ping-pong traffic does not grow the stack. With latency or a bandwidth limit, a delivery thread
+    per direction passes the bytes on when they are due.
+
+    Parameters
+    ----------
+    callback : function
+       The function that newly arrived packets should be passed to. Should have exactly one argument.
+    framed, start_byte, end_byte, escape_byte, octet_stuff_byte, framing:
+       As for FramedPacketConnection.
+    latency: float
+       The time in seconds it takes the bytes to reach the other end.
+    bandwidth: float
+       The number of bytes per second the link can carry, or None for no limit.
+    corruption: float
+       The probability that a byte is corrupted on its way, by flipping one of its bits.
+    buffer_size: int
+       With latency or a bandwidth limit, sending blocks while this many bytes are on their way.
+    seed: int
+       Seeds the random numbers used for corruption, to make a simulation repeatable.
+    """
+    def __init__(self, callback, framed = True, start_byte = def_start_byte, end_byte = def_end_byte,
+                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte, framing = None,
+                 latency = 0., bandwidth = None, corruption = 0., buffer_size = def_buffer_size, seed = None):
+        FramedPacketConnection.__init__(self, callback, False, framed, start_byte, end_byte, escape_byte,
+                                        octet_stuff_byte, framing)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.corruption = corruption
+        self.buffer_size = buffer_size
+        self.random = random.Random(seed)
+        self.peer = None
+        self.link = None
+        self.corrupted_bytes = 0
+
+    """ Connects this end to the other end. Should only be used internally, see loopback_pair(). """
+    def connect(self, peer):
+        self.peer = peer
+        self.link = _Link(peer, self.latency, self.bandwidth, self.buffer_size)
+        self.change_state(ready)
+
+    """ Passes data on to the other end. Returns whether the connection is ready. """
+    def write(self, data):
+        if self.state != ready:
+            return False
+        if not data:
+            return True   # An empty chunk would tell the other end that the connection was closed
+        data = str(data)   # The caller may reuse its buffer
+        if self.corruption > 0:
+            data = self.corrupt(data)
+        self.link.send(data)
+        for hook in self.hooks:
+            hook.bytes_sent(self, len(data))
+        return True
+
+    """ Flips a random bit in every byte that is hit by corruption """
+    def corrupt(self, data):
+        if self.corruption >= 1:
+            positions = xrange(len(data))
+        else:
+            positions = []
+            log_keep = math.log(1. - self.corruption)
+            pos = -1
+            while True:
+                # The distance to the next corrupted byte is geometrically distributed
+                pos += 1 + int(math.log(1. - self.random.random()) / log_keep)
+                if pos >= len(data):
+                    break
+                positions.append(pos)
+        if not positions:
+            return data
+        data = bytearray(data)
+        for pos in positions:
+            data[pos] ^= 1 << self.random.randrange(8)
+        self.corrupted_bytes += len(positions)
+        return str(data)
+
+    def connection_reset(self):
+        if D: print "LoopbackConnection reset"
+        self.reset_receive_state()
+        if self.state != dead:
+            self.change_state(disconnected)
+
+    """ Closes both ends. The other end is reset as if its socket was closed. """
+    def closeConnection(self):
+        self.disable_batching()
+        self.disable_send_queue()
+        self.stop_recording()
+        if self.state == dead:
+            return
+        self.change_state(dead)
+        if self.link is not None:
+            self.link.close()
+            self.link.stop()
+        if self.peer is not None and self.peer.state != dead:
+            self.peer.closeConnection()
+
+
+""" Returns two connected LoopbackConnections that pass their packets to callback_a and callback_b.
+    The keyword arguments, e.g. latency or framing, are passed to both. """
+def loopback_pair(callback_a, callback_b, **options):
+    a = LoopbackConnection(callback_a, **options)
+    b = LoopbackConnection(callback_b, **options)
+    a.connect(b)
+    b.connect(a)
+    return a, b
+
+
+_local = threading.local()
+
+
+class _Link(object):
+    """ Carries the bytes of one direction to the receiving connection """
+    def __init__(self, receiver, latency, bandwidth, buffer_size):
+        self.receiver = receiver
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.buffer_size = buffer_size
+        self.lock = Lock()   # Serializes deliveries, like the receiving thread of a socket
+        self.condition = Condition()
+        self.queue = deque()   # (time the data is due, data)
+        self.in_flight = 0
+        self.busy_until = 0.
+        self.running = True
+        self.thread = None
+        if latency > 0 or bandwidth is not None:
+            self.thread = Thread(target = self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def send(self, data):
+        if self.thread is None:
+            self.deliver_now(data)
+            return
+        with self.condition:
+            while self.in_flight > 0 and self.in_flight + len(data) > self.buffer_size and self.running:
+                self.condition.wait()
+            sent = max(time(), self.busy_until)
+            if self.bandwidth is not None:
+                sent += len(data) / float(self.bandwidth)
+            self.busy_until = sent
+            self.queue.append((sent + self.latency, data))
+            self.in_flight += len(data)
+            self.condition.notify_all()
+
+    """ Tells the receiving connection that the connection was closed, after the data that is on its way """
+    def close(self):
+        if self.thread is None:
+            self.deliver_now(None)
+            return
+        with self.condition:
+            self.queue.append((max(time(), self.busy_until) + self.latency, None))
+            self.condition.notify_all()
+
+    """ Passes data to the receiving connection. None stands for the end of the connection. """
+    def deliver(self, data):
+        if data is None:
+            self.receiver.connection_reset()
+        else:
+            self.receiver.data_callback(data)
+
+    """ Delivers data on the calling thread. If the thread is already delivering, the data is delivered
+        once the current callback returned. """
+    def deliver_now(self, data):
+        pending = getattr(_local, "pending", None)
+        if pending is not None:
+            pending.append((self, data))
+            return
+        pending = _local.pending = deque([(self, data)])
+        try:
+            while pending:
+                link, data = pending.popleft()
+                with link.lock:
+                    link.deliver(data)
+        finally:
+            _local.pending = None
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                due, data = self.queue[0]
+            delay = due - time()
+            if delay > 0:
+                sleep(delay)
+            with self.condition:
+                self.queue.popleft()
+                if data is not None:
+                    self.in_flight -= len(data)
+                self.condition.notify_all()
+            with self.lock:
+                self.deliver(data)
@@ -1,6 +1,75 @@
 import struct
+import array
+import sys
+from collections import deque
 from time import time
 
+def_pool_size = 1024
+
+# Return types of the list parsing methods
+as_list = "list"
+as_array = "array"
+as_ndarray = "ndarray"
+
+_native_endian = {"little": "<", "big": ">"}[sys.byteorder]
+_numpy_types = {"i": "i4", "f": "f4"}
+
+
+class _Codecs(object):
+    """ Precompiled struct formats for one byte order """
+    def __init__(self, endian):
+        self.int = struct.Struct(endian + "i")
+        self.float = struct.Struct(endian + "f")
+        self.char = struct.Struct(endian + "c")
+        self.endian = endian
+    
+    """ Packs a sequence of values with the given struct type code into a string with a single call """
+    def pack_values(self, code, values):
+        numpy = sys.modules.get("numpy")
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            return values.astype(self.endian + _numpy_types[code]).tostring()
+        if isinstance(values, array.array) and values.typecode == code and values.itemsize == 4:
+            if self.endian != _native_endian:
+                values = array.array(code, values)
+                values.byteswap()
+            return values.tostring()
+        return struct.pack(self.endian + str(len(values)) + code, *values)
+    
+    """ Unpacks n values with the given struct type code from data, starting at offset """
+    def unpack_values(self, code, data, offset, n, as_type = as_list):
+        if as_type == as_ndarray:
+            return _import_numpy().frombuffer(data, self.endian + _numpy_types[code], n, offset)
+        if as_type == as_array:
+            if offset + 4 * n > len(data):
+                # Like struct.unpack_from, rather than returning fewer values than announced
+                raise struct.error("unpack_from requires a buffer of at least %d bytes" % (4 * n))
+            val = array.array(code)
+            val.fromstring(buffer(data, offset, 4 * n))
+            if self.endian != _native_endian:
+                val.byteswap()
+            return val
+        return list(struct.unpack_from(self.endian + str(n) + code, data, offset))
+
+
+""" Imports numpy when it is needed for the first time, so that importing this module stays cheap """
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required to parse into an ndarray")
+    return numpy
+
+
+""" Returns whether lst can be parsed by the list methods of a packet. An ndarray can only have been
+    created if numpy was imported already, so numpy is not imported here. """
+def _is_sequence(lst):
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(lst, numpy.ndarray):
+        return True
+    return isinstance(lst, (list, tuple, array.array))
+
+_codecs = {"<": _Codecs("<"), ">": _Codecs(">")}
+
 
 class Packet(object):
     """
@@ -19,6 +88,10 @@ class Packet(object):
     
     Packet framing is done independently by the bluetooth connection.
     
+    By default the bytes are kept in an immutable string. For packets that are built from many appends 
+    (e.g. long lists), a buffered packet keeps its bytes in a growable bytearray instead. Appending to it
+    is amortized O(1) and the pop-methods read directly from the buffer without slicing out copies.
+    
     Parameters
     ----------
     
@@ -26,21 +99,43 @@ class Packet(object):
         If specified, the given packet is cloned.
     littleendian: boolean
         Defines whether the bytes in this packet are in little or big endian order.
+    buffered: boolean
+        If True, the bytes are stored in a bytearray instead of a string. get_data() then returns the bytearray.
     """
+    __slots__ = ("data", "buffered", "start_time", "end_time", "endian", "codecs", "position", "pool")
          
-    def __init__(self, copy = None, littleendian = True):
+    def __init__(self, copy = None, littleendian = True, buffered = False):
         if copy is not None:
-            self.data = copy.data
+            self.buffered = copy.buffered
+            if copy.buffered:
+                self.data = bytearray(copy.data)
+            else:
+                self.data = copy.data
             self.start_time = copy.start_time
             self.end_time = copy.end_time
             self.endian = copy.endian
         else:
-            self.data = ""
+            self.buffered = buffered
+            self.data = self._wrap("")
             self.start_time = 0
             self.end_time = 0
             if littleendian: self.endian = "<"
             else: self.endian = ">"
+        self.codecs = _codecs[self.endian]
         self.position = 0 # Read/write byte position
+        self.pool = None  # The PacketPool this packet is returned to by release()
+    
+    """ Returns this packet to the PacketPool it was taken from, so that it is reused for another received 
+        packet. The packet must not be used anymore afterwards. Does nothing if the packet is not from a pool. """
+    def release(self):
+        if self.pool is not None:
+            self.pool.release(self)
+    
+    """ Converts the given bytes to the storage type of this packet """
+    def _wrap(self, data):
+        if self.buffered:
+            return bytearray(data)
+        return data
     
     """ Sets the time in ms when the first byte of the packet was received. If no time is given, 
         the current time is used."""
@@ -69,9 +164,9 @@ class Packet(object):
     
     """ Swap the bytes of this packet for the bytes given in data """
     def put_data(self, data):
-        self.data = data
+        self.data = self._wrap(data)
     
-    """ Get the bytes currently stored in this packet """
+    """ Get the bytes currently stored in this packet (a bytearray for buffered packets) """
     def get_data(self):
         return self.data
     
@@ -81,83 +176,119 @@ class Packet(object):
         self.data += b
         self.position += 1
     
+    """ Appends a string of raw bytes to the current data stored in this packet. """
+    def append_bytes(self, data):
+        self.data += data
+        self.position += len(data)
+    
         
     ### Ints ###
     
     """ Store an int in this packet """     
     def put_int(self, integer):
-        self.data = struct.pack(self.endian + "i", integer)
+        self.data = self._wrap(self.codecs.int.pack(integer))
 
     
     """ Get an int from this packet """     
     def get_int(self):
         if len(self.data)==4:
-            return struct.unpack(self.endian + "i", self.data)[0]#
+            return self.codecs.int.unpack_from(self.data)[0]
         else:
             print "Only 4-byte packets can be parsed into ints."
     
     """ Parse the next bytes into an int. """
     def pop_int(self):
-        val = struct.unpack(self.endian+"i", self.data[self.position:self.position+4])[0]
+        val = self.codecs.int.unpack_from(self.data, self.position)[0]
         self.position += 4
         return val
         
     """ Append an int to this packet """     
     def append_int(self, integer):
-        self.data += struct.pack(self.endian+"i", integer)
+        self.data += self.codecs.int.pack(integer)
         self.position += 4
     
     ### Chars ###
     """ Store a char in this packet """
     def put_char(self, char):
-        self.data = struct.pack(self.endian + "c", char)
+        self.data = self._wrap(self.codecs.char.pack(char))
 
     """ Get a char from this packet """     
     def get_char(self):
-        return struct.unpack(self.endian + "c", self.data)[0]
+        return self.codecs.char.unpack_from(self.data)[0]
     
     """ Parse the next byte into a char. """
     def pop_char(self):
-        val = struct.unpack(self.endian+"c", self.data[self.position])[0]
+        val = self.codecs.char.unpack_from(self.data, self.position)[0]
         self.position += 1
         return val
         
     """ Append a char to this packet """     
     def append_char(self, char):
-        self.data += struct.pack(self.endian+"c", char)
+        self.data += self.codecs.char.pack(char)
         self.position += 1
     
     ### Strings ###
     """ Store a string in this packet """     
     def put_string(self, string):
-        for character in string:
-            self.append_char(character)
+        self.append_bytes(string)
 
     """ Get a string from this packet """     
     def get_string(self):
-        res = ""
-        for _ in range(len(self.data)):
-            res += self.pop_char()
-        return res
+        self.position = len(self.data)
+        return str(self.data)
     
     """ Parse the next bytes into a string. """
     def pop_string(self):
         length = self.pop_int()
-        res = ""
-        for _ in range(length):
-            res += self.pop_char()
-        return res
+        return self.pop_bytes(length)
+    
+    """ Parse the next bytes into a string, returned as a memoryview of the packet data 
+        instead of a copy. """
+    def pop_string_view(self):
+        length = self.pop_int()
+        return self.pop_bytes_view(length)
         
     """ Append a string to this packet """     
     def append_string(self, string):
         self.append_int(len(string))
-        for ch in string:
-            self.append_char(ch)
+        self.append_bytes(string)
+    
+    ### Raw bytes ###
+    """ Returns the next n bytes as a string """
+    def pop_bytes(self, n):
+        if self.position + n > len(self.data):
+            raise ValueError("Only %d bytes left in packet" % (len(self.data) - self.position))
+        start = self.position
+        self.position += n
+        return str(self.data[start:self.position])
+    
+    """ Returns the next n bytes as a memoryview of the packet data, without copying them """
+    def pop_bytes_view(self, n):
+        if self.position + n > len(self.data):
+            raise ValueError("Only %d bytes left in packet" % (len(self.data) - self.position))
+        start = self.position
+        self.position += n
+        return self.view_data()[start:self.position]
+    
+    """ Returns a memoryview of all data in this packet. The view of a string packet is read-only. A buffered
+        packet cannot grow or shrink while a view of its bytearray exists, appending raises a BufferError then,
+        so that the view never refers to freed memory. """
+    def view_data(self):
+        return memoryview(self.data)
+    
+    """ Returns a read-only view of this packet. It shares the data of this packet without copying it
+        and has its own read position. """
+    def view(self):
+        return PacketView(self)
+    
+    """ Parses the records stored one after another from the current position, see Schema.iter_records() """
+    def iter_records(self, schema, lazy = True, as_type = as_list):
+        return schema.iter_records(self, lazy, as_type)
         
     ### Floats ###
     """ Store a float in this packet """
     def put_float(self, val):
-        self.data = ""
+        self.data = self._wrap("")
         self.append_float(val)
     
     def get_float(self):
@@ -168,7 +299,7 @@ class Packet(object):
     Pop a float from the current position
     """            
     def pop_float(self):
-        val = struct.unpack(self.endian+"f", self.data[self.position:self.position+4])[0]
+        val = self.codecs.float.unpack_from(self.data, self.position)[0]
         self.position += 4
         return val 
     
@@ -176,54 +307,49 @@ class Packet(object):
     Append a float to this packet
     """
     def append_float(self, val):
-        self.data += struct.pack(self.endian+"f", val)
+        self.data += self.codecs.float.pack(val)
         self.position += 4
         
     
     ### Float lists ###
     
     """
-    Pop a float list from the current position
+    Pop a float list from the current position. as_type selects whether a list, an array.array
+    or a numpy.ndarray is returned (see as_list, as_array and as_ndarray).
     """
-    def pop_float_list(self):
+    def pop_float_list(self, as_type = as_list):
         if not len(self.data) < 4:
             if len(self.data)%4 == 0:  
                 # First is the length of the list as an int         
                 length = self.pop_int()
-                val = [self.pop_float() for _ in range(length)]
-                return val
+                return self._pop_values("f", length, as_type)
             else:
                 print "The stored data cannot be parsed into a list of floats."
     
     """ Append a list of floats to this packet """
     def append_float_list(self, lst):
-        if type(lst)==list:
+        if _is_sequence(lst):
             # First append the length of the list
             self.append_int(len(lst))
-            for val in lst:
-                self.append_float(val)
+            self._append_values("f", lst)
         else:
             print "arg lst may only be of type list!"
         
         
     """ Parse the data in this packet into a list of floats """
-    def read_float_list(self):
+    def read_float_list(self, as_type = as_list):
         if not (len(self.data) == 0): 
             if len(self.data)%4 == 0:
-                val = []
                 self.position = 0
-                while self.position<len(self.data):
-                    val.append(self.pop_float())
-                return val
+                return self._pop_values("f", len(self.data) // 4, as_type)
             else:
                 print "The stored data cannot be parsed into a list of floats."
     
 
     """ Store a list of floats in this packet """
     def put_float_list(self, lst):
-        if type(lst)==list:
-            for val in lst:
-                self.append_float(val)
+        if _is_sequence(lst):
+            self._append_values("f", lst)
         else:
             print "arg lst may only be of type list!"
 
@@ -232,49 +358,164 @@ class Packet(object):
     
         
     """ Parse the data in this packet into a list of ints """
-    def read_int_list(self):
+    def read_int_list(self, as_type = as_list):
         if not (len(self.data) == 0): 
             if len(self.data)%4 == 0:
-                val = []
                 self.position = 0
-                while self.position<len(self.data):
-                    val.append(self.pop_int())
-                return val
+                return self._pop_values("i", len(self.data) // 4, as_type)
             else:
                 print "The stored data cannot be parsed into a list of ints."
     
 
     """ Store a list of ints in this packet """
     def put_int_list(self, lst):
-        if type(lst)==list:
-            for val in lst:
-                self.append_int(val)
+        if _is_sequence(lst):
+            self._append_values("i", lst)
         else:
             print "arg lst may only be of type list!"
     
     
     """
-    Pop an int list from the current position
+    Pop an int list from the current position. as_type selects whether a list, an array.array
+    or a numpy.ndarray is returned (see as_list, as_array and as_ndarray).
     """
-    def pop_int_list(self):
+    def pop_int_list(self, as_type = as_list):
         if not len(self.data) < 4:
             if len(self.data)%4 == 0:  
                 # First is the length of the list as an int         
                 length = self.pop_int()
-                val = [self.pop_int() for _ in range(length)]
-                return val
+                return self._pop_values("i", length, as_type)
             else:
                 print "The stored data cannot be parsed into a list of ints."
     
     """ Append a list of ints to this packet """
     def append_int_list(self, lst):
-        if type(lst)==list:
+        if _is_sequence(lst):
             # First append the length of the list
             self.append_int(len(lst))
-            for val in lst:
-                self.append_int(val)
+            self._append_values("i", lst)
         else:
             print "arg lst may only be of type list!"
-        
     
-        
\ No newline at end of file
+    ### Bulk codecs ###
+    
+    """ Append all values of lst as 4-byte items of the given struct type code ("i" or "f") in one go """
+    def _append_values(self, code, lst):
+        self.data += self.codecs.pack_values(code, lst)
+        self.position += 4 * len(lst)
+    
+    """ Parse the next n 4-byte items of the given struct type code ("i" or "f") in one go """
+    def _pop_values(self, code, n, as_type):
+        val = self.codecs.unpack_values(code, self.data, self.position, n, as_type)
+        self.position += 4 * n
+        return val
+
+
+""" Returns a new little endian packet holding a received payload. Is faster than creating an empty packet 
+    and filling it. If pool is given, the packet is taken from it. """
+def received_packet(data, start_time, end_time, pool = None):
+    if pool is not None:
+        return pool.acquire(data, start_time, end_time)
+    pck = _new(Packet)
+    pck.data = data
+    pck.buffered = False
+    pck.start_time = start_time
+    pck.end_time = end_time
+    pck.endian = "<"
+    pck.codecs = _little_endian
+    pck.position = 0
+    pck.pool = None
+    return pck
+
+_new = object.__new__
+_little_endian = _codecs["<"]
+
+
+class PacketPool(object):
+    """
+    Keeps released packets so that they can be reused for received packets instead of allocating new ones.
+    A connection uses a pool after enable_packet_pool() was called. Consumers call release() on a packet
+    once they are done with it; packets that are never released are simply garbage collected.
+
+    Allocating a packet with __slots__ is cheap, so a pool does not speed up consumers that drop their
+    packets right away. It pays off when packets are held for a while, e.g. in a receive buffer or
+    dispatcher queue, where every newly allocated packet counts towards the next garbage collection.
+
+    Parameters
+    ----------
+
+    max_size: int
+        The maximum number of released packets that are kept.
+    """
+    def __init__(self, max_size = def_pool_size):
+        self.max_size = max_size
+        self.free = deque()
+        self.created = 0
+        self.reused = 0
+
+    """ Returns a little endian packet holding data, reusing a released packet if there is one """
+    def acquire(self, data, start_time, end_time):
+        try:
+            pck = self.free.pop()
+            self.reused += 1
+        except IndexError:
+            pck = received_packet(data, start_time, end_time)
+            pck.pool = self
+            self.created += 1
+            return pck
+        pck.data = data
+        pck.start_time = start_time
+        pck.end_time = end_time
+        pck.position = 0
+        return pck
+
+    """ Takes back a packet. Should only be used internally, see Packet.release(). """
+    def release(self, pck):
+        if pck.position == _released:
+            raise ValueError("Packet was released twice")
+        if len(self.free) < self.max_size:
+            pck.data = ""
+            if pck.buffered or pck.codecs is not _little_endian:
+                pck.buffered = False
+                pck.endian = "<"
+                pck.codecs = _little_endian
+            pck.position = _released
+            self.free.append(pck)
+
+    """ Returns the number of packets ready for reuse """
+    def size(self):
+        return len(self.free)
+
+_released = -1
+
+
+class PacketView(Packet):
+    """
+    A read-only packet that shares the data of another packet. The get- and pop-methods work as usual
+    and start at position 0; all methods that would change the data raise a TypeError.
+
+    Parameters
+    ----------
+
+    pck: Packet
+        The packet whose data is viewed.
+    """
+    __slots__ = ()
+
+    def __init__(self, pck):
+        self.data = pck.data
+        self.buffered = pck.buffered
+        self.start_time = pck.start_time
+        self.end_time = pck.end_time
+        self.endian = pck.endian
+        self.codecs = pck.codecs
+        self.position = 0
+        self.pool = None
+
+    def _read_only(self, *args):
+        raise TypeError("PacketView is read-only")
+
+    put_data = append_byte = append_bytes = _read_only
+    put_int = append_int = put_char = append_char = put_float = append_float = _read_only
+    put_string = append_string = _read_only
+    put_float_list = append_float_list = put_int_list = append_int_list = _read_only
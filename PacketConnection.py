@@ -1,13 +1,24 @@
-from bluetooth import BluetoothSocket, RFCOMM, discover_devices, BluetoothError
-from threading import Thread
-from Packet import Packet
-import ipdb
+import Queue
+import socket
+from threading import Lock
+from time import time
+from Packet import PacketPool, def_pool_size
+from Framing import ByteStuffingFraming, Unframed
+from Batching import Batcher, def_max_bytes, def_max_delay
+from BoundedQueue import BoundedQueue, block, drop
+from Capture import Recorder
+from Compression import Compressor, def_threshold, def_level, def_max_size
+from Fragmentation import Fragmenter, Reassembler, def_max_pending, def_max_pending_bytes
+from SendQueue import SendQueue, def_max_frames, def_max_write, def_reconnect_timeout
 
 def_start_byte = '\xfc'
 def_end_byte = '\xfd'
 def_escape_byte = '\xfe'
 def_octet_stuff_byte = '\x20'
 def_max_packet_size = 232
+def_recv_size = 65536
+def_max_buffered = 1024
+def_poll_interval = .1
 
 # States
 connected = 1
@@ -18,7 +29,7 @@ escaping = 5
 received = 6
 dead = 7
 
-D = True
+D = False
 
 class FramedPacketConnection(object):
     """
@@ -27,7 +38,9 @@ class FramedPacketConnection(object):
     Parameters
     ----------
     callback : function
-       The function that newly arrived packets should be passed to. Should have exactly one argument. 
+       The function that newly arrived packets should be passed to. Should have exactly one argument.
+       May be None if the packets are fetched with packets() or recv_batch() instead; the receive buffer
+       is then enabled right away, so no packet is lost before they are called.
     auto_reconnect: boolean
        Defines whether the socket should be automatically reopened after connection loss.
     framed: boolean
@@ -41,101 +54,369 @@ class FramedPacketConnection(object):
        If framed = True, use this as the escape character. (default: '\xfe')
     octet_stuff_byte: byte
        If framed = True, use this byte to do octet stuffing and unstuffing on escaped characters. 
+    framing: function
+       If given, is called to create the framing object of this connection, e.g. Framing.CobsFraming or
+       Framing.LengthPrefixFraming. The byte arguments above are then ignored. Both sides of a connection
+       have to use the same framing.
        
     """
     def __init__(self, callback, auto_reconnect = True, framed = True, start_byte = def_start_byte, end_byte = def_end_byte, 
-                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte):
+                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte, framing = None):
         self.callback = callback
         self.start_byte = start_byte
         self.end_byte = end_byte
         self.escape_byte = escape_byte
         self.octet_stuff_byte = octet_stuff_byte
-        self.curr_packet = Packet()
         self.auto_reconnect = auto_reconnect
         self.framed = framed
+        if framing is not None:
+            self.framing = framing()
+        elif framed:
+            self.framing = ByteStuffingFraming(start_byte, end_byte, escape_byte, octet_stuff_byte)
+        else:
+            self.framing = Unframed(start_byte, end_byte, escape_byte, octet_stuff_byte)
         self.state = disconnected
         self.server = None   # Says whether this connection is running in server mode.
+        self.send_buffer = bytearray()   # Reused by sendPackets
+        self.send_buffer_lock = Lock()
+        self.write_lock = Lock()
+        self.send_queue = None
+        self.batcher = None
+        self.packet_dispatcher = None
+        self.receive_buffer = None
+        self.packet_pool = None
+        self.hooks = []   # ConnectionHooks, see Instrumentation
+        self.fragmenter = None
+        self.reassembler = None
+        self.compressor = None
+        self.recorder = None
+        self.supervisor = None   # Set by connections that reconnect with a Supervisor
+        self.was_ready = False
+        if callback is None:
+            self.enable_receive_buffer()
 
     
+    """ Pass received packets to callback from now on. Packets that are still in the receive buffer are passed to
+        it first, and the receive buffer is disabled. """
+    def set_callback(self, callback):
+        self.callback = callback
+        self.disable_receive_buffer()
+    
     """ Change the state of this Bluetooth Connection. Should only be used internally. """
     def change_state(self, new_state):
         if D: print "Changing state to " + repr(new_state)
+        if new_state == ready:
+            self.was_ready = True
         self.state = new_state
     
-    """ Method to be called when a new byte comes in 
-        on the open socket. Parses the bytes into packets. """ 
-    def byte_callback(self, dat):
-        #ipdb.set_trace()
+    """ Method to be called when a new chunk of bytes comes in on the open socket. 
+        Parses the bytes into packets and passes each completed packet to the callback. 
+        An empty chunk signals that the connection was closed. """
+    def data_callback(self, dat):
         if dat == "":
             self.connection_reset()
             return
         
-        if self.framed:
-            if self.state == ready:
-                if dat == self.start_byte:
-                    self.curr_packet.set_start_time()
-                    self.change_state(incoming)
-                
-            elif self.state == incoming:
-                if dat == self.escape_byte:
-                    self.change_state(escaping)
-                elif dat == self.end_byte:
-                    self.curr_packet.set_end_time()
-                    self.change_state(received)
-                else:
-                    self.curr_packet.append_byte(dat)
-                    
-            elif self.state == escaping:
-                dat = chr(ord(dat)^ord(self.octet_stuff_byte))
-                self.curr_packet.append_byte(dat)
-                self.change_state(incoming)
-            
-            if self.state == received:
-                self.change_state(ready)
-                self.callback(Packet(self.curr_packet))
-                self.curr_packet = Packet()
-                
-        # In unframed mode, 1 byte = 1 packet.         
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(dat)
+        packets = self.framing.feed(dat)
+        if self.hooks:
+            for hook in self.hooks:
+                hook.bytes_received(self, len(dat))
+                for pck in packets:
+                    hook.frame_received(self, pck)
+        if self.reassembler is not None:
+            packets = self.reassembler.reassemble(packets)
+        if self.compressor is not None:
+            count = len(packets)
+            packets = self.compressor.decompress_packets(packets)
+            if len(packets) < count and self.hooks:
+                self.report_dropped(count - len(packets), "corrupt")
+        for pck in packets:
+            self.deliver(pck)
+    
+    """ Passes a received packet to the callback, through the dispatcher if there is one, or puts it into
+        the receive buffer if it is enabled """
+    def deliver(self, pck):
+        receive_buffer = self.receive_buffer
+        if receive_buffer is not None:
+            if not self.buffer_packet(receive_buffer, pck) and self.hooks:
+                self.report_dropped(1, "receive buffer full" if self.state != dead else "closed")
+        elif self.packet_dispatcher is not None:
+            self.packet_dispatcher.submit(self, self.callback, pck)
+        elif self.hooks:
+            start = time()
+            self.callback(pck)
+            duration = time() - start
+            for hook in self.hooks:
+                hook.callback_finished(self, pck, duration)
         else:
-            self.change_state(incoming)
-            self.curr_packet.append_byte(dat)
-            self.change_state(ready)
-            self.callback(Packet(self.curr_packet))
-            self.curr_packet.set_start_time()
-            self.curr_packet = Packet()
+            self.callback(pck)
+    
+    """ Puts a packet into the receive buffer. While a blocking buffer is full, the state is checked regularly,
+        so that closing the connection does not wait for a consumer that stopped reading. Returns whether the
+        packet was buffered. Should only be used internally. """
+    def buffer_packet(self, receive_buffer, pck):
+        if receive_buffer.overflow != block:
+            return receive_buffer.offer(pck)
+        while self.state != dead:
+            try:
+                receive_buffer.put(pck, True, def_poll_interval)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    
+    """ Keep received packets in a buffer of at most max_packets packets instead of passing them to the callback,
+        so they can be fetched with packets() or recv_batch(). overflow is BoundedQueue.block, which holds up
+        the receiving thread while the buffer is full, or BoundedQueue.drop, which discards new packets. """
+    def enable_receive_buffer(self, max_packets = def_max_buffered, overflow = block):
+        if overflow not in (block, drop):
+            raise ValueError("The receive buffer can only block or drop")
+        self.receive_buffer = BoundedQueue(max_packets, overflow)
+    
+    """ Pass received packets to the callback again. Packets that are still buffered are passed to it first. """
+    def disable_receive_buffer(self):
+        receive_buffer = self.receive_buffer
+        self.receive_buffer = None
+        if receive_buffer is not None:
+            for pck in receive_buffer.get_available(receive_buffer.qsize()):
+                self.deliver(pck)
+    
+    """ Yields the received packets. Ends if no packet arrives within timeout seconds (None waits forever)
+        or once the connection was closed or lost for good (see may_receive()) and all buffered packets were
+        yielded. Enables the receive buffer if needed; packets that arrived before were passed to the callback. """
+    def packets(self, timeout = None):
+        if self.receive_buffer is None:
+            self.enable_receive_buffer()
+        while True:
+            pck = self.next_packet(timeout)
+            if pck is None:
+                return
+            yield pck
+    
+    """ Waits up to max_wait seconds (None waits forever) for a received packet, then returns it together 
+        with the packets that are already buffered, at most max_n packets. Returns an empty list if no packet
+        arrived in time or the connection was closed. """
+    def recv_batch(self, max_n = def_max_buffered, max_wait = None):
+        if self.receive_buffer is None:
+            self.enable_receive_buffer()
+        pck = self.next_packet(max_wait)
+        if pck is None:
+            return []
+        return [pck] + self.receive_buffer.get_available(max_n - 1)
+    
+    """ Returns the next buffered packet, or None after timeout seconds or if the connection was closed """
+    def next_packet(self, timeout):
+        receive_buffer = self.receive_buffer
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            wait = def_poll_interval if deadline is None else min(def_poll_interval, deadline - time())
+            try:
+                return receive_buffer.get(True, max(wait, 0))
+            except Queue.Empty:
+                if not self.may_receive() or (deadline is not None and time() >= deadline):
+                    return None
+    
+    """ Returns whether packets may still arrive: False once the connection was closed, or lost without
+        being reopened """
+    def may_receive(self):
+        if self.state == dead:
+            return False
+        if self.supervisor is not None:
+            return self.supervisor.running
+        return self.state != disconnected or self.auto_reconnect or not self.was_ready
+    
+    """ Attach a ConnectionHook that is notified about the traffic of this connection """
+    def add_hook(self, hook):
+        self.hooks = self.hooks + [hook]
+    
+    def remove_hook(self, hook):
+        self.hooks = [h for h in self.hooks if h is not hook]
+    
+    """ Notify the hooks that frames were lost. Should only be used internally. """
+    def report_dropped(self, count, reason):
+        for hook in self.hooks:
+            hook.frames_dropped(self, count, reason)
+    
+    """ Hand received packets to a PacketDispatcher instead of calling the callback on the receiving thread.
+        A dispatcher can be shared by several connections. Pass None to call the callback directly again. """
+    def set_dispatcher(self, dispatcher):
+        self.packet_dispatcher = dispatcher
+    
+    """ Method to be called when a new byte comes in 
+        on the open socket. Chunks of any length are accepted as well. """ 
+    def byte_callback(self, dat):
+        self.data_callback(dat)
             
     
-    """ Send raw data (without using packets). This method should only be used internally """
-    def sendData(self, data):
-        # XXX: This could wait for connection to be ready and then try again
-        if self.state == ready:
-            self.client_socket.send(data)
+    """ Send raw data (without using packets). If batching or a send queue is enabled, the data is only 
+        buffered or queued. This method should only be used internally """
+    def sendData(self, data, frames = 1):
+        if self.batcher is not None:
+            self.batcher.add(data, frames)
         else:
-            if D: print "State is:  " + repr(self.state)
-            ipdb.set_trace()
+            self.send_now(data, frames)
+    
+    """ Send raw data without batching, through the send queue if it is enabled. 
+        This method should only be used internally """
+    def send_now(self, data, frames = 1):
+        if self.send_queue is not None:
+            if not self.send_queue.put(data) and self.hooks:
+                self.report_dropped(frames, "queue full")
+        elif not self.write(data):
             if D: print "Connection is not ready, cannot send packet!"
+            if self.hooks:
+                self.report_dropped(frames, "not ready")
+    
+    """ Write raw data to the socket. Returns whether the data was written. The sockets have a timeout for
+        the receiving thread; if it expires while sending, e.g. because the peer stalls, the rest of the data
+        is sent once the socket takes it again. This method should only be used internally """
+    def write(self, data):
+        if self.state != ready:
+            return False
+        try:
+            with self.write_lock:
+                sock = self.client_socket
+                sent = 0
+                while sent < len(data):
+                    try:
+                        sent += sock.send(buffer(data, sent) if sent else data)
+                    except IOError, e:
+                        if not self.is_timeout(e) or self.state == dead:
+                            raise
+            for hook in self.hooks:
+                hook.bytes_sent(self, len(data))
+            return True
+        except (IOError, AttributeError):
+            # The socket was closed or replaced in the meantime
+            return False
+    
+    """ Returns whether a socket error only says that the timeout of the socket expired """
+    def is_timeout(self, error):
+        return isinstance(error, socket.timeout)
+    
+    """ Send all data through a queue that is emptied by a writer thread. 
+        See SendQueue for the parameters. """
+    def enable_send_queue(self, max_frames = def_max_frames, overflow = block, max_write = def_max_write, 
+                          reconnect_timeout = def_reconnect_timeout):
+        self.disable_send_queue()
+        self.send_queue = SendQueue(self, max_frames, overflow, max_write, reconnect_timeout)
+    
+    """ Stop the writer thread and send data directly again """
+    def disable_send_queue(self):
+        if self.send_queue is not None:
+            self.send_queue.stop()
+            self.send_queue = None
+    
+    """ Returns the number of frames waiting in the send queue """
+    def send_queue_depth(self):
+        if self.send_queue is None:
+            return 0
+        return self.send_queue.depth()
+    
+    """ Collect frames in a buffer that is sent when it holds max_bytes bytes, or max_delay seconds after
+        its first frame was added, to save system calls for many small frames. See Batching.Batcher. """
+    def enable_batching(self, max_bytes = def_max_bytes, max_delay = def_max_delay):
+        self.disable_batching()
+        self.batcher = Batcher(self, max_bytes, max_delay)
+    
+    """ Send the buffered frames and stop batching """
+    def disable_batching(self):
+        if self.batcher is not None:
+            batcher = self.batcher
+            self.batcher = None
+            batcher.stop()
+    
+    """ Send the frames buffered by batching right away """
+    def flush(self):
+        batcher = self.batcher
+        if batcher is not None:
+            batcher.flush()
+    
+    """ Split packets larger than max_packet_size bytes into fragments, which are framed and sent one by one.
+        Fragments of different packets may be interleaved, so small packets don't have to wait until a large 
+        packet was sent completely. Received fragments are reassembled, keeping at most max_pending incomplete 
+        packets with max_pending_bytes bytes. Both sides of a connection have to enable fragmentation. """
+    def enable_fragmentation(self, max_packet_size = def_max_packet_size, max_pending = def_max_pending, 
+                             max_pending_bytes = def_max_pending_bytes):
+        self.fragmenter = Fragmenter(max_packet_size)
+        self.reassembler = Reassembler(max_pending, max_pending_bytes)
+    
+    """ Take received packets from a pool of at most max_size released packets instead of allocating new ones. 
+        The callback should call release() on a packet once it is done with it; packets that are not released
+        are garbage collected as usual. """
+    def enable_packet_pool(self, max_size = def_pool_size):
+        self.packet_pool = PacketPool(max_size)
+        self.framing.pool = self.packet_pool
+    
+    """ Append all received bytes with timestamps to a capture file, which can be replayed with Capture.replay() """
+    def start_recording(self, path, flush = False):
+        self.stop_recording()
+        self.recorder = Recorder(path, flush)
+    
+    def stop_recording(self):
+        recorder = self.recorder
+        if recorder is not None:
+            self.recorder = None
+            recorder.close()
+    
+    """ Compress packets with at least threshold bytes with zlib. Every payload gets a flag byte, so
+        compressed and uncompressed packets can be mixed. Received packets that decompress to more than
+        max_size bytes are dropped. Both sides of a connection have to enable compression. """
+    def enable_compression(self, threshold = def_threshold, level = def_level, max_size = def_max_size):
+        self.compressor = Compressor(threshold, level, max_size)
+    
+    """ Returns the payloads of the frames a packet is sent in """
+    def payloads(self, pck):
+        dat = str(pck.get_data())
+        if self.compressor is not None:
+            dat = self.compressor.compress(dat)
+        if self.fragmenter is not None:
+            return self.fragmenter.split(dat)
+        return [dat]
     
     """ Frames and sends a packet over the connection """
     def sendPacket(self, pck):
-        dat = pck.get_data()
-        lst = []
-        lst.append(self.start_byte)
-        
-        for i in range(len(dat)):
-            if (self.needs_escaping(dat[i])):
-                lst.append(self.escape_byte)
-                # XXX: Ugly line of code.
-                lst.append(chr(ord(dat[i])^ord(self.octet_stuff_byte)))
-            else:
-                lst.append(dat[i])
-        
-        lst.append(self.end_byte)
-        print "Connection sending data: " + repr(lst)
-        self.sendData("".join(lst))
+        for dat in self.payloads(pck):
+            self.sendPayload(dat)
+    
+    """ Frames and sends a single payload as returned by payloads(). Should only be used internally """
+    def sendPayload(self, dat):
+        frame = self.framing.encode(dat)
+        if D: print "Connection sending %d bytes" % len(frame)
+        for hook in self.hooks:
+            hook.frame_sent(self, len(dat), len(frame))
+        self.sendData(frame)
+    
+    """ Frames several packets into one buffer and sends them with a single call """
+    def sendPackets(self, pcks):
+        with self.send_buffer_lock:
+            buf = self.send_buffer
+            for pck in pcks:
+                for dat in self.payloads(pck):
+                    size = len(buf)
+                    self.framing.encode_into(buf, dat)
+                    for hook in self.hooks:
+                        hook.frame_sent(self, len(dat), len(buf) - size)
+            if D: print "Connection sending %d packets in %d bytes" % (len(pcks), len(buf))
+            try:
+                self.sendData(buf, len(pcks))
+            finally:
+                del buf[:]
     
     def connection_reset(self):
         if D: print "PacketConnection is being reset."
-        self.curr_packet = Packet()
+        self.reset_receive_state()
+    
+    """ Discards partially received packets. Should only be used internally. """
+    def reset_receive_state(self):
+        partial = self.framing.reset()
+        if self.reassembler is not None:
+            partial = self.reassembler.reset() or partial
+        if partial and self.hooks:
+            self.report_dropped(1, "partial")
         
     def is_ready(self):
         return self.state == ready
@@ -0,0 +1,279 @@
+import heapq
+import struct
+import traceback
+from threading import Thread, Lock, Condition, Event, BoundedSemaphore, current_thread
+from time import time
+from Packet import Packet
+
+def_max_in_flight = 256
+def_timeout = 10.
+def_poll_interval = .05
+
+# Message kinds
+request = 0
+response = 1
+failure = 2
+cancel = 3
+
+# Kind, sequence id
+_header = struct.Struct("<BI")
+
+D = False
+
+
+class RPCError(Exception):
+    """ The remote handler failed, or the call could not be completed """
+    pass
+
+
+class RPCTimeout(RPCError):
+    """ No response arrived in time """
+    pass
+
+
+class CancelledError(RPCError):
+    """ The call was cancelled """
+    pass
+
+
+class Future(object):
+    """
+    The result of a call that is still in flight. result() waits for the response packet. Callbacks added
+    with add_done_callback() are called with the future once it is done, on the thread that completed it.
+    """
+    def __init__(self, endpoint, seq):
+        self.endpoint = endpoint
+        self.seq = seq
+        self.condition = Condition(Lock())
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def cancelled(self):
+        return isinstance(self.error, CancelledError)
+
+    """ Waits for the response and returns it as a packet. Raises an RPCError if the call failed and
+        RPCTimeout if there is no response after timeout seconds; the call stays in flight in that case. """
+    def result(self, timeout = None):
+        self.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    """ Waits for the call to finish and returns its RPCError, or None if it succeeded """
+    def exception(self, timeout = None):
+        self.wait(timeout)
+        return self.error
+
+    def wait(self, timeout = None):
+        with self.condition:
+            if not self.finished:
+                self.condition.wait(timeout)
+            if not self.finished:
+                raise RPCTimeout("No response to call %d after %ss" % (self.seq, timeout))
+
+    """ Cancels the call. The peer skips the request if it has not handled it yet. Returns False if the call
+        had already finished. """
+    def cancel(self):
+        if not self.set_error(CancelledError("Call %d was cancelled" % self.seq)):
+            return False
+        self.endpoint.cancelled(self.seq)
+        return True
+
+    def add_done_callback(self, fn):
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    """ Completes the future. Returns False if it was already done. Should only be used internally. """
+    def set_result(self, value):
+        return self._finish(value, None)
+
+    def set_error(self, error):
+        return self._finish(None, error)
+
+    def _finish(self, value, error):
+        with self.condition:
+            if self.finished:
+                return False
+            self.value = value
+            self.error = error
+            self.finished = True
+            self.condition.notify_all()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+        return True
+
+
+class RPCEndpoint(object):
+    """
+    Request/response calls over a FramedPacketConnection. Every packet is prefixed with its kind and a
+    sequence id, which is echoed in the response, so many calls can be in flight at the same time and the
+    responses may arrive in any order. An endpoint can make calls and answer the calls of its peer at the
+    same time; both sides of a connection need an endpoint.
+
+    The endpoint becomes the callback of the connection. Requests are answered on the thread that calls
+    the callback, so if the handler is slow, give the connection an unordered PacketDispatcher to handle
+    several requests at once.
+
+    Parameters
+    ----------
+
+    connection: FramedPacketConnection
+        The connection the calls are sent over.
+    handler: function
+        Is called with every request packet and returns the response packet (None for an empty response).
+        If it raises an exception, the caller gets an RPCError with its message. If not given, requests
+        of the peer are answered with an error.
+    max_in_flight: int
+        The maximum number of calls waiting for their response. call() blocks while there are more.
+    timeout: float
+        The default time in seconds after which a call fails with RPCTimeout. None means no timeout.
+    """
+    def __init__(self, connection, handler = None, max_in_flight = def_max_in_flight, timeout = def_timeout):
+        self.connection = connection
+        self.handler = handler
+        self.timeout = timeout
+        self.slots = BoundedSemaphore(max_in_flight)
+        self.lock = Lock()
+        self.next_seq = 0
+        self.pending = {}       # sequence id -> Future
+        self.deadlines = []     # heap of (deadline, sequence id)
+        self.active = set()     # Ids of received requests that were not answered yet
+        self.skipped = set()    # Ids of received requests that the peer cancelled
+        self.completed = 0
+        self.timed_out = 0
+        self.invalid = 0
+        self.running = True
+        self.stopped = Event()
+        self.thread = Thread(target = self.expire)
+        self.thread.daemon = True
+        self.thread.start()
+        connection.set_callback(self.packet_received)
+
+    """ Sends a request packet and returns a Future for the response. timeout overrides the default timeout. """
+    def call(self, pck, timeout = -1):
+        if timeout == -1:
+            timeout = self.timeout
+        self.slots.acquire()
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq = (self.next_seq + 1) & 0xffffffff
+            future = Future(self, seq)
+            self.pending[seq] = future
+            if timeout is not None:
+                heapq.heappush(self.deadlines, (time() + timeout, seq))
+        future.add_done_callback(self._release)
+        self.send(request, seq, str(pck.get_data()))
+        return future
+
+    """ Sends a request and waits for the response packet """
+    def request(self, pck, timeout = -1):
+        return self.call(pck, timeout).result()
+
+    """ Returns the number of calls waiting for their response """
+    def in_flight(self):
+        return len(self.pending)
+
+    """ Fails all calls in flight and stops the timeout thread. Does not close the connection. """
+    def close(self):
+        self.running = False
+        self.stopped.set()
+        if self.thread is not current_thread():
+            self.thread.join()
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.set_error(RPCError("The endpoint was closed"))
+
+    """ The callback of the connection. Should only be used internally. """
+    def packet_received(self, pck):
+        data = str(pck.get_data())
+        if len(data) < _header.size:
+            self.invalid += 1
+            return
+        kind, seq = _header.unpack_from(data)
+        pck.put_data(data[_header.size:])
+        pck.position = 0
+        if kind == request:
+            self.answer(seq, pck)
+        elif kind == response or kind == failure:
+            with self.lock:
+                future = self.pending.get(seq)
+            if future is None:
+                return  # Timed out or cancelled
+            if kind == response:
+                future.set_result(pck)
+            else:
+                future.set_error(RPCError(str(pck.get_data())))
+        elif kind == cancel:
+            with self.lock:
+                if seq in self.active:
+                    self.skipped.add(seq)
+        else:
+            self.invalid += 1
+
+    """ Runs the handler for a request and sends its response """
+    def answer(self, seq, pck):
+        with self.lock:
+            self.active.add(seq)
+        try:
+            if self.handler is None:
+                raise RPCError("The endpoint does not accept calls")
+            with self.lock:
+                if seq in self.skipped:
+                    return
+            result = self.handler(pck)
+            data = "" if result is None else str(result.get_data())
+            self.send(response, seq, data)
+        except Exception, e:
+            if D: traceback.print_exc()
+            self.send(failure, seq, "%s: %s" % (type(e).__name__, e))
+        finally:
+            with self.lock:
+                self.active.discard(seq)
+                self.skipped.discard(seq)
+
+    """ Tells the peer that a call was cancelled. Should only be used internally. """
+    def cancelled(self, seq):
+        self.send(cancel, seq, "")
+
+    def send(self, kind, seq, data):
+        out = Packet()
+        out.put_data(_header.pack(kind, seq) + data)
+        self.connection.sendPacket(out)
+
+    def _release(self, future):
+        with self.lock:
+            self.pending.pop(future.seq, None)
+        if future.error is None:
+            self.completed += 1
+        self.slots.release()
+
+    """ Fails the calls whose timeout has passed. Runs on the timeout thread. """
+    def expire(self):
+        while self.running:
+            now = time()
+            expired = []
+            with self.lock:
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    _, seq = heapq.heappop(self.deadlines)
+                    future = self.pending.get(seq)
+                    if future is not None:
+                        expired.append(future)
+                wait = self.deadlines[0][0] - now if self.deadlines else def_poll_interval
+            for future in expired:
+                if future.set_error(RPCTimeout("No response to call %d" % future.seq)):
+                    self.timed_out += 1
+            self.stopped.wait(min(wait, def_poll_interval))
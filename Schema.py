@@ -0,0 +1,222 @@
+import struct
+from Packet import Packet, as_list
+
+# Field types
+int_type = "i"
+float_type = "f"
+char_type = "c"
+string_type = "string"
+int_list_type = "int_list"
+float_list_type = "float_list"
+
+_fixed_types = (int_type, float_type, char_type)
+_list_codes = {int_list_type: "i", float_list_type: "f"}
+
+
+class Schema(object):
+    """
+    Describes the layout of a record that is stored in a packet. The fields are declared once and compiled
+    into precomputed struct formats, so a whole record can be written to or read from a packet in one pass.
+
+    Consecutive fixed-size fields are packed by a single struct, together with the length prefix of a
+    following string or list field. The layout of every field is the same as the one produced by the
+    corresponding append-method of Packet, e.g. a string field is stored like append_string() stores it.
+
+    Parameters
+    ----------
+
+    fields: list
+        A list of (name, type) tuples, where type is one of int_type, float_type, char_type, string_type,
+        int_list_type and float_list_type.
+    """
+    def __init__(self, fields):
+        self.fields = list(fields)
+        if not self.fields:
+            raise ValueError("A schema needs at least one field")
+        self.names = [name for name, _ in self.fields]
+        for name, field_type in self.fields:
+            if field_type not in _fixed_types and field_type != string_type and field_type not in _list_codes:
+                raise ValueError("Unknown type " + repr(field_type) + " of field " + repr(name))
+        self._programs = {}
+        # Index of the segment of the compiled program that holds each field
+        self._segments = {}
+        segment = 0
+        for name, field_type in self.fields:
+            self._segments[name] = segment
+            if field_type not in _fixed_types:
+                segment += 1
+
+    """ Returns the compiled segments for the given byte order. Each segment is a tuple of a struct
+        for the fixed-size fields (and the length of the variable field), their names, and the name and
+        type of the variable-size field that follows (None if there is none). """
+    def _program(self, endian):
+        program = self._programs.get(endian)
+        if program is None:
+            program = []
+            fmt = endian
+            names = []
+            for name, field_type in self.fields:
+                if field_type in _fixed_types:
+                    fmt += field_type
+                    names.append(name)
+                else:
+                    # The length prefix is packed together with the preceding fixed fields
+                    program.append((struct.Struct(fmt + "i"), names, name, field_type))
+                    fmt = endian
+                    names = []
+            if names:
+                program.append((struct.Struct(fmt), names, None, None))
+            self._programs[endian] = program
+        return program
+
+    """ Appends a record to the packet pck (a new packet if None is given) and returns the packet.
+        The record can be a dict or a sequence of values in the order of the fields. """
+    def pack(self, record, pck = None):
+        if pck is None:
+            pck = Packet()
+        if not isinstance(record, dict):
+            record = dict(zip(self.names, record))
+        pieces = []
+        for fixed, names, var_name, var_type in self._program(pck.endian):
+            values = [record[name] for name in names]
+            if var_name is None:
+                pieces.append(fixed.pack(*values))
+                continue
+            var = record[var_name]
+            values.append(len(var))
+            pieces.append(fixed.pack(*values))
+            if var_type == string_type:
+                pieces.append(var)
+            else:
+                pieces.append(pck.codecs.pack_values(_list_codes[var_type], var))
+        pck.append_bytes("".join(pieces))
+        return pck
+
+    """ Reads a record from the current position of the packet and returns it as a dict.
+        as_type selects the return type of list fields, as in Packet.pop_float_list(). """
+    def unpack(self, pck, as_type = as_list):
+        record = {}
+        pos = pck.position
+        for segment in self._program(pck.endian):
+            pos = _decode_segment(segment, pck.data, pos, pck.codecs, as_type, record)
+        pck.position = pos
+        return record
+
+    """ Iterates over the records stored one after another from the current position of the packet up to
+        its end. If lazy is True, a RecordView is yielded for every record: only the length prefixes are read
+        to find the next record, and a field is decoded when it is accessed. Otherwise every record is
+        unpacked into a dict. The position of the packet is advanced past each record before it is yielded. """
+    def iter_records(self, pck, lazy = True, as_type = as_list):
+        program = self._program(pck.endian)
+        while pck.position < len(pck.data):
+            if not lazy:
+                yield self.unpack(pck, as_type)
+                continue
+            offsets = _offsets(program, pck.data, pck.position, pck.endian)
+            pck.position = offsets[-1]
+            yield RecordView(self, pck, offsets, as_type)
+
+
+class RecordView(object):
+    """
+    A record in a packet that is decoded lazily, field by field. Decoded fields are cached. The view
+    refers to the data of the packet, so the packet must not be changed while the view is used.
+
+    Parameters
+    ----------
+
+    schema: Schema
+        The layout of the record.
+    pck: Packet
+        The packet that holds the record.
+    offsets: list
+        The start of every segment of the compiled schema, followed by the end of the record.
+    as_type: str
+        The return type of list fields, as in Packet.pop_float_list().
+    """
+    def __init__(self, schema, pck, offsets, as_type = as_list):
+        self.schema = schema
+        self.data = pck.data
+        self.codecs = pck.codecs
+        self.program = schema._program(pck.endian)
+        self.offsets = offsets
+        self.as_type = as_type
+        self.decoded = {}
+
+    def __getitem__(self, name):
+        if name not in self.decoded:
+            segment = self.schema._segments[name]
+            _decode_segment(self.program[segment], self.data, self.offsets[segment], self.codecs,
+                            self.as_type, self.decoded)
+        return self.decoded[name]
+
+    def __contains__(self, name):
+        return name in self.schema._segments
+
+    def get(self, name, default = None):
+        if name not in self.schema._segments:
+            return default
+        return self[name]
+
+    def keys(self):
+        return list(self.schema.names)
+
+    """ Returns the number of bytes of this record """
+    def size(self):
+        return self.offsets[-1] - self.offsets[0]
+
+    """ Returns a string field as a memoryview of the packet data, without copying it. See Packet.view_data(). """
+    def view(self, name):
+        segment = self.schema._segments[name]
+        fixed, _, var_name, var_type = self.program[segment]
+        if var_name != name or var_type != string_type:
+            raise ValueError(repr(name) + " is not a string field")
+        start = self.offsets[segment] + fixed.size
+        end = self.offsets[segment + 1]
+        return memoryview(self.data)[start:end]
+
+    """ Returns the whole record as a dict """
+    def unpack(self):
+        for name in self.schema.names:
+            self[name]
+        return dict(self.decoded)
+
+
+""" Decodes one compiled segment from data at pos into the dict record and returns the position after it """
+def _decode_segment(segment, data, pos, codecs, as_type, record):
+    fixed, names, var_name, var_type = segment
+    values = fixed.unpack_from(data, pos)
+    pos += fixed.size
+    if var_name is None:
+        record.update(zip(names, values))
+        return pos
+    record.update(zip(names, values[:-1]))
+    length = values[-1]
+    if var_type == string_type:
+        record[var_name] = str(data[pos:pos + length])
+        return pos + length
+    record[var_name] = codecs.unpack_values(_list_codes[var_type], data, pos, length, as_type)
+    return pos + 4 * length
+
+
+_length = {"<": struct.Struct("<i"), ">": struct.Struct(">i")}
+
+""" Returns the start of every segment of the record at pos, followed by the end of the record. Only the
+    length prefixes are read. Raises a ValueError if the record does not fit into data. """
+def _offsets(program, data, pos, endian):
+    offsets = [pos]
+    for fixed, _, var_name, var_type in program:
+        if pos + fixed.size > len(data):
+            raise ValueError("Truncated record at byte %d" % offsets[0])
+        if var_name is not None:
+            length = _length[endian].unpack_from(data, pos + fixed.size - 4)[0]
+            if length < 0:
+                raise ValueError("Invalid length in record at byte %d" % offsets[0])
+            if var_type != string_type:
+                length *= 4
+            pos += length
+        pos += fixed.size
+        offsets.append(pos)
+    if pos > len(data):
+        raise ValueError("Truncated record at byte %d" % offsets[0])
+    return offsets
@@ -0,0 +1,107 @@
+import Queue
+from threading import Thread
+from time import time, sleep
+from BoundedQueue import BoundedQueue, block
+
+def_max_frames = 1024
+def_max_write = 65536
+def_reconnect_timeout = 5.0
+def_poll_interval = .01
+def_check_interval = .1   # How often blocked threads check whether the queue was stopped
+
+D = False
+
+
+class SendQueue(object):
+    """
+    Buffers outgoing frames of a connection and writes them from a dedicated thread, so that
+    producers never wait for the socket. Frames that are queued while the writer is busy are
+    coalesced into a single write.
+
+    If the connection is not ready, e.g. while it reconnects, the writer holds on to its frames for
+    up to reconnect_timeout seconds before it gives up on them.
+
+    Parameters
+    ----------
+    connection: FramedPacketConnection
+        The connection whose write() method is used to send the frames.
+    max_frames: int
+        The maximum number of frames waiting in the queue.
+    overflow: int
+        What to do if the queue is full. One of BoundedQueue.block, BoundedQueue.drop and BoundedQueue.error.
+    max_write: int
+        Frames are coalesced until a write has at least this many bytes.
+    reconnect_timeout: float
+        How long frames are kept while the connection is not ready.
+    """
+    def __init__(self, connection, max_frames = def_max_frames, overflow = block, max_write = def_max_write,
+                 reconnect_timeout = def_reconnect_timeout):
+        self.connection = connection
+        self.queue = BoundedQueue(max_frames, overflow)
+        self.max_write = max_write
+        self.reconnect_timeout = reconnect_timeout
+        self.dropped_frames = 0   # Frames that could not be sent before reconnect_timeout
+        self.running = True
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Queues a frame. Returns whether it was accepted. With the block policy, waits while the queue is full,
+        but gives up once the queue is stopped. """
+    def put(self, frame):
+        if isinstance(frame, bytearray):
+            frame = str(frame)
+        if self.queue.overflow != block:
+            return self.queue.offer(frame)
+        while self.running:
+            try:
+                self.queue.put(frame, True, def_check_interval)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    """ Returns the number of frames waiting to be written """
+    def depth(self):
+        return self.queue.qsize()
+
+    """ Returns the number of frames that were rejected because the queue was full """
+    def overflowed_frames(self):
+        return self.queue.dropped
+
+    """ Stops the writer thread. Frames that are still queued are discarded, and producers that wait for room
+        in the queue return. """
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.queue.get_available(self.queue.qsize())
+
+    def run(self):
+        while self.running:
+            try:
+                frames = [self.queue.get(True, def_check_interval)]
+            except Queue.Empty:
+                continue
+            size = len(frames[0])
+            while size < self.max_write:
+                more = self.queue.get_available(64)
+                if not more:
+                    break
+                frames.extend(more)
+                size += sum(len(frame) for frame in more)
+            self.write(frames)
+
+    """ Writes frames as one chunk, waiting for the connection to become ready if needed """
+    def write(self, frames):
+        data = "".join(frames)
+        deadline = time() + self.reconnect_timeout
+        while self.running:
+            if self.connection.is_ready() and self.connection.write(data):
+                return
+            if time() > deadline:
+                break
+            sleep(def_poll_interval)
+        self.dropped_frames += len(frames)
+        if self.connection.hooks:
+            self.connection.report_dropped(len(frames), "send timeout")
+        if D: print "Send queue dropped %d frames" % len(frames)
@@ -0,0 +1,174 @@
+import random
+from threading import Thread, Event, current_thread
+from time import time
+from Instrumentation import LatencyHistogram
+
+def_initial_delay = .005   # Delay of the first retry
+def_base_delay = .05
+def_max_delay = 5.
+def_factor = 2.
+def_jitter = .5
+
+# States, as in PacketConnection
+disconnected = 2
+dead = 7
+
+D = False
+
+
+class Backoff(object):
+    """
+    Computes the delays between attempts to open a connection. The first retry follows after
+    initial_delay, so a short drop of the link is recovered quickly; retry n follows after
+    base_delay * factor**(n-1) seconds, but never more than max_delay. Every delay is shortened by a
+    random fraction of up to jitter, so that clients that lost the same server do not retry in lockstep.
+
+    Parameters
+    ----------
+
+    initial_delay: float
+        The delay of the first retry in seconds.
+    base_delay: float
+        The delay of the second retry in seconds.
+    max_delay: float
+        The upper bound of all delays in seconds.
+    factor: float
+        The growth of the delay from one retry to the next.
+    jitter: float
+        The maximum fraction by which a delay is shortened, between 0 and 1.
+    """
+    def __init__(self, initial_delay = def_initial_delay, base_delay = def_base_delay, max_delay = def_max_delay,
+                 factor = def_factor, jitter = def_jitter):
+        self.initial_delay = initial_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+
+    """ Returns the delay before the given retry, counting from 0 """
+    def delay(self, attempt):
+        if attempt == 0:
+            delay = self.initial_delay
+        else:
+            delay = min(self.max_delay, self.base_delay * self.factor ** min(attempt - 1, 64))
+        return delay * (1. - self.jitter * random.random())
+
+
+class Supervisor(object):
+    """
+    Owns the lifecycle of a connection. A single thread opens the connection, runs its receive loop
+    and, if the connection is lost and auto_reconnect is set, opens it again with exponential backoff.
+    Since the receive loop runs on the supervisor thread, a connection uses exactly one receiving thread
+    however often it reconnects, and reconnecting does not grow the stack.
+
+    Parameters
+    ----------
+
+    connection: FramedPacketConnection
+        The supervised connection. Its hooks are notified about reconnects.
+    open: function
+        Opens the connection and returns once it is ready. Is called without arguments and raises one
+        of errors if the connection could not be opened.
+    receive: function
+        Runs the receive loop of the open connection and returns when the connection is lost or closed.
+    errors: tuple
+        The exceptions raised by open that cause a retry.
+    backoff: Backoff
+        Computes the delays between the attempts. If not given, a Backoff with the default delays is used.
+    """
+    def __init__(self, connection, open, receive, errors = (IOError,), backoff = None):
+        self.connection = connection
+        self.open = open
+        self.receive = receive
+        self.errors = errors
+        if backoff is None:
+            backoff = Backoff()
+        self.backoff = backoff
+        self.running = False
+        self.connected = Event()
+        self.stopped = Event()
+        self.thread = None
+        self.connects = 0
+        self.reconnects = 0
+        self.failures = 0   # Attempts to open the connection that failed
+        self.reconnect_times = LatencyHistogram()   # Time from losing the connection to reopening it
+        self.max_reconnect_time = 0.
+
+    """ Starts supervising the connection on a new thread. If block is True, the calling thread is used
+        instead, and this method only returns once the supervisor was stopped. """
+    def start(self, block = False):
+        self.running = True
+        if block:
+            self.thread = current_thread()
+            self.run()
+        else:
+            self.thread = Thread(target = self.run)
+            self.thread.start()
+
+    """ Waits until the connection is open. Returns False if it was not opened within timeout seconds. """
+    def wait_connected(self, timeout = None):
+        while self.running and not self.connected.is_set():
+            if timeout is not None and timeout <= 0:
+                break
+            self.connected.wait(.1 if timeout is None else min(timeout, .1))
+            if timeout is not None:
+                timeout -= .1
+        return self.connected.is_set()
+
+    """ Stops opening the connection. The caller has to close the sockets, which ends the receive loop. """
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+
+    """ Waits until the supervisor thread has finished """
+    def join(self, timeout = None):
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join(timeout)
+
+    def run(self):
+        attempt = 0
+        lost_at = None
+        while self.running:
+            try:
+                self.open()
+            except self.errors, e:
+                self.failures += 1
+                if not self.running:
+                    break
+                delay = self.backoff.delay(attempt)
+                if D: print "Could not connect (%s), retrying in %.3fs" % (e, delay)
+                attempt += 1
+                self.stopped.wait(delay)
+                continue
+
+            attempt = 0
+            self.connects += 1
+            if lost_at is not None:
+                duration = time() - lost_at
+                self.reconnects += 1
+                self.reconnect_times.add(duration)
+                self.max_reconnect_time = max(self.max_reconnect_time, duration)
+                if D: print "Reconnected after %.3fs" % duration
+                for hook in self.connection.hooks:
+                    hook.reconnected(self.connection)
+            self.connected.set()
+
+            self.receive()
+
+            self.connected.clear()
+            lost_at = time()
+            if self.connection.state != dead:
+                self.connection.change_state(disconnected)
+            if not self.connection.auto_reconnect:
+                break
+        self.running = False
+
+    """ Returns the number of connects, reconnects and failed attempts, and the time reconnecting took """
+    def metrics(self):
+        times = self.reconnect_times
+        return {"connects": self.connects,
+                "reconnects": self.reconnects,
+                "failures": self.failures,
+                "mean_reconnect_time": times.mean(),
+                "p99_reconnect_time": times.percentile(99),
+                "max_reconnect_time": self.max_reconnect_time}
@@ -1,15 +1,13 @@
 import socket
-from threading import Thread
-import ipdb
 from PacketConnection import FramedPacketConnection
-from Packet import Packet
-import time
+from Supervisor import Supervisor
 
 def_start_byte = '\xfc'
 def_end_byte = '\xfd'
 def_escape_byte = '\xfe'
 def_octet_stuff_byte = '\x20'
 def_max_packet_size = 232
+def_recv_size = 65536
 
 # States
 connected = 1
@@ -20,7 +18,7 @@ escaping = 5
 received = 6
 dead = 7
 
-D = True
+D = False
     
 class TCPConnection(FramedPacketConnection):
     """
@@ -29,7 +27,9 @@ class TCPConnection(FramedPacketConnection):
     Parameters
     ----------
     callback : function
-       The function that newly arrived packets should be passed to. Should have exactly one argument. 
+       The function that newly arrived packets should be passed to. Should have exactly one argument.
+       May be None if the packets are fetched with packets() or recv_batch() instead.
+       The receive buffer is then enabled right away.
     auto_reconnect: boolean
        Defines whether the socket should be automatically reopened after connection loss.
     framed: boolean
@@ -43,83 +43,135 @@ class TCPConnection(FramedPacketConnection):
        If framed = True, use this as the escape character. (default: '\xfe')
     octet_stuff_byte: byte
        If framed = True, use this byte to do octet stuffing and unstuffing on escaped characters. 
+    framing: function
+       If given, is called to create the framing object of this connection, e.g. Framing.CobsFraming or
+       Framing.LengthPrefixFraming. The byte arguments above are then ignored. Both sides of a connection
+       have to use the same framing.
        
     """
     def __init__(self, callback, auto_reconnect = True, framed = True, start_byte = def_start_byte, end_byte = def_end_byte, 
-                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte):
-        FramedPacketConnection.__init__(self, callback, auto_reconnect, framed, start_byte, end_byte, escape_byte, octet_stuff_byte)
+                 escape_byte = def_escape_byte, octet_stuff_byte = def_octet_stuff_byte, framing = None):
+        FramedPacketConnection.__init__(self, callback, auto_reconnect, framed, start_byte, end_byte, escape_byte, octet_stuff_byte,
+                                        framing)
         self.client_socket = None
         self.server_socket = None
+        self.supervisor = None
+        self.socket_options = []
         self.state = disconnected
         
-    """ Open port and wait for other devices to connect """
-    def createServer(self, port = 5000):
+    """ Open port and wait for other devices to connect. Returns once the first client is connected; if the
+        client is lost, the next one is accepted on the same port by the supervisor. 
+        If nodelay is True, Nagle's algorithm is disabled, so small frames are sent without delay. 
+        socket_options is a list of (level, option, value) tuples that are set on the sockets, 
+        e.g. [(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)]. """
+    def createServer(self, port = 5000, backoff = None, nodelay = False, socket_options = ()):
         self.port = port
+        self.socket_options = socket_options_for(nodelay, socket_options)
         self.server_socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # XXX: Reuse address maybe shouldnt be default?
+        set_socket_options(self.server_socket, self.socket_options)
         self.server_socket.bind(("", port))
         self.server = True
         if D: print "This server is now reachable under the name " + socket.gethostname()
         self.server_socket.listen(1)
+        self.server_socket.settimeout(.5)
         
-        if D: print "Trying to connect.."
-        self.client_socket, address = self.server_socket.accept()
-        self.client_socket.settimeout(.5)
-        if D: print "Now connected to "+ repr(address)
-        self.change_state(ready)
+        self.supervisor = Supervisor(self, self.accept, self.receive, backoff = backoff)
+        self.supervisor.start()
+        self.supervisor.wait_connected()
     
-        thread = Thread(target=listen_at_socket, args=(self.client_socket, self.byte_callback, self.connection_reset))
-        thread.start()
-
-    
-    """ Actively connect to another device with an address """
-    def createClient(self, address, port = 5000):
+    """ Actively connect to another device with an address. Returns once the connection is open; 
+        refused attempts are retried with the delays given by backoff (see Supervisor.Backoff). 
+        nodelay and socket_options are used as in createServer(). """
+    def createClient(self, address, port = 5000, backoff = None, nodelay = False, socket_options = ()):
         self.address = address
-        self.client_socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # XXX: Reuse address maybe shouldnt be default?
+        self.port = port
+        self.socket_options = socket_options_for(nodelay, socket_options)
         self.server = False
+        self.supervisor = Supervisor(self, self.connect, self.receive, backoff = backoff)
+        self.supervisor.start()
+        self.supervisor.wait_connected()
+        if D: print "Started connected thread"
+    
+    """ Accepts the next client on the server socket. Should only be used internally. """
+    def accept(self):
         if D: print "Trying to connect.."
         while True:
             try:
-                self.client_socket.connect((address, port))
+                client_socket, address = self.server_socket.accept()
                 break
-            except socket.error, v:
-                if v[0] == 111:
-                    print "Connection was refused, retrying in a bit.."
-                    time.sleep(1)
-            
+            except socket.timeout:
+                if not self.supervisor.running:
+                    raise
+        client_socket.settimeout(.5)
+        set_socket_options(client_socket, self.socket_options)
+        self.client_socket = client_socket
+        if D: print "Now connected to "+ repr(address)
+        self.change_state(ready)
+    
+    """ Makes one attempt to connect to the server. Should only be used internally. """
+    def connect(self):
+        if D: print "Trying to connect.."
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # XXX: Reuse address maybe shouldnt be default?
+        set_socket_options(client_socket, self.socket_options)
+        try:
+            client_socket.connect((self.address, self.port))
+        except socket.error:
+            client_socket.close()
+            raise
+        client_socket.settimeout(.5)
+        self.client_socket = client_socket
         if D: print "Connected!"
         self.change_state(ready)
-        
-        thread = Thread(target=listen_at_socket, args=(self.client_socket, self.byte_callback, self.connection_reset))
-        thread.start()
-        #conn_thread = ConnectedThread(self.client_socket, self.byte_callback)
-        #conn_thread.run()
-        print "Started connected thread"
+    
+    """ Runs the receive loop until the connection is lost. Should only be used internally. """
+    def receive(self):
+        listen_at_socket(self.client_socket, self.data_callback, self.connection_reset)
         
     def connection_reset(self):
-        print "TCPConnection reset"
-        self.curr_packet = Packet()
-        if self.auto_reconnect:
-            if self.server:
-                self.createServer(self.port)
-            else:
-                self.createClient(self.address)
+        if D: print "TCPConnection reset"
+        self.reset_receive_state()
     
     """ Closes the socket """
     def closeConnection(self):
+        self.disable_batching()
+        self.disable_send_queue()
+        self.stop_recording()
+        self.change_state(dead)
+        if self.supervisor is not None:
+            self.supervisor.stop()
         if self.server_socket is not None:
             self.server_socket.close()
         
-        self.client_socket.close()
-        self.change_state(dead)
+        if self.client_socket is not None:
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.client_socket.close()
+        if self.supervisor is not None:
+            self.supervisor.join()
+
+
+""" Returns the list of (level, option, value) tuples to set on the sockets of a connection """
+def socket_options_for(nodelay, socket_options):
+    options = list(socket_options)
+    if nodelay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    return options
+
+
+def set_socket_options(sckt, options):
+    for level, option, value in options:
+        sckt.setsockopt(level, option, value)
 
 
-def listen_at_socket(sckt, callback, reset):
+def listen_at_socket(sckt, callback, reset, recv_size = def_recv_size):
     while True:
         try:
             #print "Trying to recv"
-            dat = sckt.recv(1)
+            dat = sckt.recv(recv_size)
             #print "rcv!" + repr(dat)
             callback(dat)
             if dat=="":
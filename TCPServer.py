@@ -0,0 +1,146 @@
+from threading import Lock
+from AsyncTCPConnection import AsyncTCPConnection, _Acceptor, default_loop
+
+def_start_byte = '\xfc'
+def_end_byte = '\xfd'
+def_escape_byte = '\xfe'
+def_octet_stuff_byte = '\x20'
+def_backlog = 128
+
+D = False
+
+
+class TCPServer(object):
+    """
+    A framed TCP server that talks to any number of clients at once. All client sockets are
+    multiplexed on one event loop, and every client has its own deframer, so partial frames of
+    different clients never mix.
+
+    Parameters
+    ----------
+    callback : function
+       The function that newly arrived packets should be passed to. Is called with two arguments,
+       the id of the client that sent the packet and the packet itself.
+    loop: EventLoop
+       The loop that drives the server and its clients. If not given, the shared default loop is used.
+    on_connect: function
+       If given, is called with the client id and address whenever a new client connected.
+    on_disconnect: function
+       If given, is called with the client id whenever a client disconnected.
+    framed: boolean
+       Defines whether packets used in this connection are framed by start and end bytes. If false, each packet
+       will contain exactly 1 byte.
+    start_byte: byte
+       If framed = True, use this as the start byte of a packet (default: '\xfc')
+    end_byte: byte
+       If framed = True, use this as the end byte of a packet (default: '\xfd')
+    escape_byte: byte
+       If framed = True, use this as the escape character. (default: '\xfe')
+    octet_stuff_byte: byte
+       If framed = True, use this byte to do octet stuffing and unstuffing on escaped characters.
+    framing: function
+       If given, is called to create the framing object of this connection, e.g. Framing.CobsFraming or
+       Framing.LengthPrefixFraming. The byte arguments above are then ignored. Both sides of a connection
+       have to use the same framing.
+
+    """
+    def __init__(self, callback, loop = None, on_connect = None, on_disconnect = None, framed = True,
+                 start_byte = def_start_byte, end_byte = def_end_byte, escape_byte = def_escape_byte,
+                 octet_stuff_byte = def_octet_stuff_byte, framing = None):
+        self.callback = callback
+        if loop is None:
+            loop = default_loop()
+        self.loop = loop
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.framing_args = (framed, start_byte, end_byte, escape_byte, octet_stuff_byte, framing)
+        self.acceptor = None
+        self.connections = {}   # client id -> _ClientConnection
+        self.addresses = {}     # client id -> (host, port)
+        self.lock = Lock()
+        self.next_id = 0
+
+    """ Open port and accept clients. Does not block, the clients are served by the event loop. """
+    def createServer(self, port = 5000, backlog = def_backlog):
+        self.port = port
+        self.acceptor = _Acceptor(self.loop.map, port, self.accept, backlog)
+        self.loop.wake()
+        if D: print "Server listening on port " + repr(port)
+
+    """ Called by the event loop for every accepted socket. Should only be used internally. """
+    def accept(self, sock, address):
+        with self.lock:
+            client_id = self.next_id
+            self.next_id += 1
+            conn = _ClientConnection(self, client_id, self.loop, *self.framing_args)
+            self.connections[client_id] = conn
+            self.addresses[client_id] = address
+        conn.attach(sock, address)
+        if self.on_connect is not None:
+            self.on_connect(client_id, address)
+
+    """ Called when a client disconnected. Should only be used internally. """
+    def client_lost(self, client_id):
+        with self.lock:
+            conn = self.connections.pop(client_id, None)
+            self.addresses.pop(client_id, None)
+        if conn is not None and self.on_disconnect is not None:
+            self.on_disconnect(client_id)
+
+    """ Returns the ids of all connected clients """
+    def clients(self):
+        with self.lock:
+            return list(self.connections.keys())
+
+    """ Returns the address of a connected client """
+    def address(self, client_id):
+        return self.addresses.get(client_id)
+
+    """ Frames and sends a packet to a single client. Returns False if the client is not connected. """
+    def sendPacket(self, client_id, pck):
+        conn = self.connections.get(client_id)
+        if conn is None:
+            return False
+        conn.sendPacket(pck)
+        return True
+
+    """ Sends a packet to all connected clients. The frame is only encoded once. """
+    def broadcast(self, pck):
+        with self.lock:
+            conns = list(self.connections.values())
+        if not conns:
+            return
+        frame = conns[0].framing.encode(str(pck.get_data()))
+        for conn in conns:
+            conn.sendData(frame)
+
+    """ Closes the connection to a single client """
+    def disconnect(self, client_id):
+        conn = self.connections.get(client_id)
+        if conn is not None:
+            conn.closeConnection()
+            self.client_lost(client_id)
+
+    """ Stops accepting clients and closes all client connections """
+    def closeConnection(self):
+        if self.acceptor is not None:
+            self.acceptor.close()
+            self.acceptor = None
+        for client_id in self.clients():
+            self.disconnect(client_id)
+        self.loop.wake()
+
+
+class _ClientConnection(AsyncTCPConnection):
+    """ The connection to one client of a TCPServer """
+    def __init__(self, server, client_id, loop, *framing_args):
+        AsyncTCPConnection.__init__(self, self.packet_received, loop, *framing_args)
+        self.tcp_server = server
+        self.client_id = client_id
+
+    def packet_received(self, pck):
+        self.tcp_server.callback(self.client_id, pck)
+
+    def connection_lost(self):
+        AsyncTCPConnection.connection_lost(self)
+        self.tcp_server.client_lost(self.client_id)
@@ -0,0 +1,121 @@
+from TCPConnection import TCPConnection
+from Channels import ChannelMux
+from Packet import Packet
+from threading import Thread, Event
+import socket
+import time
+
+port = 5020
+control_channel = 0
+bulk_channel = 1
+bulk_size = 1 << 18
+fragment_size = 4096
+socket_buffer = 1 << 16
+duration = 3.
+control_interval = .01
+max_control_latency = .05
+
+
+def connect_pair(server_callback, client_callback):
+    server = TCPConnection(server_callback, auto_reconnect = False)
+    thread = Thread(target = server.createServer, args = (port,))
+    thread.start()
+    client = TCPConnection(client_callback, auto_reconnect = False)
+    client.createClient("127.0.0.1", port)
+    thread.join()
+    # Keep the kernel from buffering seconds of bulk data
+    client.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socket_buffer)
+    server.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buffer)
+    for conn in (server, client):
+        conn.enable_fragmentation(fragment_size)
+    return server, client
+
+
+class Receiver():
+    """ Measures the latency of control packets, which carry their index in sent_times """
+    def __init__(self):
+        self.sent_times = {}
+        self.latencies = []
+        self.bulk_bytes = 0
+
+    def control(self, pck):
+        self.latencies.append(time.time() - self.sent_times[pck.get_int()])
+
+    def bulk(self, pck):
+        self.bulk_bytes += len(pck.get_data())
+
+    def percentile(self, p):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100. * len(latencies)))]
+
+
+def run(receiver, send_control, send_bulk):
+    """ Saturates the link with bulk packets and sends a control packet every control_interval seconds """
+    stop = Event()
+    bulk = Packet()
+    bulk.put_data("\x5a" * bulk_size)
+
+    def bulk_sender():
+        while not stop.is_set():
+            send_bulk(bulk)
+    thread = Thread(target = bulk_sender)
+    thread.start()
+    end = time.time() + duration
+    while time.time() < end:
+        control = Packet()
+        index = len(receiver.sent_times)
+        control.put_int(index)
+        receiver.sent_times[index] = time.time()
+        send_control(control)
+        time.sleep(control_interval)
+    stop.set()
+    thread.join()
+
+
+def report(name, receiver):
+    print "%s: %d control packets, median latency %.1fms, p99 %.1fms, bulk %.1f MB/s" % (
+        name, len(receiver.latencies), receiver.percentile(50) * 1e3, receiver.percentile(99) * 1e3,
+        receiver.bulk_bytes / duration / 1e6)
+
+
+if __name__=="__main__":
+    # Without channels, control packets queue up behind bulk packets
+    receiver = Receiver()
+    def fifo_callback(pck):
+        if len(pck.get_data()) == bulk_size:
+            receiver.bulk(pck)
+        else:
+            receiver.control(pck)
+    server, client = connect_pair(fifo_callback, lambda pck: None)
+    client.enable_send_queue(max_frames = 256)
+    try:
+        run(receiver, client.sendPacket, client.sendPacket)
+        time.sleep(.5)
+    finally:
+        client.closeConnection()
+        server.closeConnection()
+    report("FIFO", receiver)
+    fifo_p99 = receiver.percentile(99)
+
+    # With channels, control packets overtake the bulk packets
+    port += 1
+    receiver = Receiver()
+    server, client = connect_pair(None, None)
+    server_mux = ChannelMux(server)
+    server_mux.open_channel(control_channel, receiver.control, priority = 1)
+    server_mux.open_channel(bulk_channel, receiver.bulk)
+    client_mux = ChannelMux(client)
+    control = client_mux.open_channel(control_channel, None, priority = 1)
+    bulk = client_mux.open_channel(bulk_channel, None)
+    try:
+        run(receiver, control.sendPacket, bulk.sendPacket)
+        time.sleep(.5)
+    finally:
+        client_mux.stop()
+        client.closeConnection()
+        server.closeConnection()
+    report("Channels", receiver)
+
+    assert receiver.percentile(99) < max_control_latency, "Control latency is not bounded"
+    assert receiver.percentile(99) < fifo_p99, "Channels did not reduce the control latency"
+    print "Control latency stays below %dms while the bulk channel saturates the link" % (max_control_latency * 1e3)
@@ -0,0 +1,96 @@
+from Discovery import DeviceCache
+from threading import Event
+import os
+import tempfile
+import time
+
+scan_duration = .2
+ttl = .5
+devices = ["00:11:22:33:44:55", "66:77:88:99:AA:BB"]
+
+
+class StubDiscovery():
+    """ Replaces bluetooth.discover_devices with a slow scan that returns a fixed list of devices """
+    def __init__(self, devices):
+        self.devices = devices
+        self.calls = 0
+        self.release = None
+
+    def __call__(self, duration):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait()
+        else:
+            time.sleep(scan_duration)
+        return list(self.devices)
+
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+
+if __name__=="__main__":
+    path = os.path.join(tempfile.mkdtemp(), "peers.json")
+
+    # The first search scans, later searches within the ttl are answered from the cache
+    stub = StubDiscovery(devices)
+    cache = DeviceCache(ttl = ttl, path = path, discover = stub)
+    found, elapsed = timed(cache.devices)
+    assert found == devices and elapsed >= scan_duration and stub.calls == 1
+    found, elapsed = timed(cache.devices)
+    assert found == devices and elapsed < scan_duration / 2 and stub.calls == 1
+    print "Cached search took %.2fms instead of %.0fms" % (elapsed * 1e3, scan_duration * 1e3)
+
+    # After the ttl, the stale devices are returned at once while a new scan runs in the background
+    stub.release = Event()
+    stub.devices = devices + ["CC:DD:EE:FF:00:11"]
+    time.sleep(ttl)
+    found, elapsed = timed(cache.devices)
+    assert found == devices and elapsed < scan_duration / 2
+    time.sleep(.05)
+    assert cache.scanning and stub.calls == 2
+    stub.release.set()
+    time.sleep(.05)
+    assert cache.devices() == stub.devices and stub.calls == 2
+
+    # The connected peer is remembered first and survives a restart
+    cache.remember(devices[1])
+    assert cache.first() == devices[1]
+    restarted = DeviceCache(ttl = ttl, path = path, discover = StubDiscovery([]))
+    first, elapsed = timed(restarted.first)
+    assert first == devices[1] and elapsed < scan_duration / 2
+    print "Restarted cache connects to %s without waiting for a scan" % first
+
+    # Without background refreshing, a stale cache waits for the scan
+    stub = StubDiscovery(devices)
+    cache = DeviceCache(ttl = ttl, discover = stub, background = False)
+    cache.devices()
+    time.sleep(ttl)
+    found, elapsed = timed(cache.devices)
+    assert elapsed >= scan_duration and stub.calls == 2
+
+    # A failed scan is raised if there is nothing cached
+    def failing(duration):
+        raise IOError("No bluetooth adapter")
+    try:
+        DeviceCache(discover = failing).devices()
+        assert False, "The failed scan was not raised"
+    except IOError:
+        pass
+
+    # Refreshing in the background keeps the cache fresh
+    stub = StubDiscovery(devices)
+    cache = DeviceCache(ttl = ttl, discover = stub)
+    cache.start_refreshing(interval = ttl / 2)
+    time.sleep(scan_duration * 1.5)
+    for _ in xrange(10):
+        found, elapsed = timed(cache.devices)
+        assert found == devices and elapsed < scan_duration / 2
+        time.sleep(ttl / 5)
+    cache.stop()
+    metrics = cache.metrics()
+    print metrics
+    assert metrics["hits"] == 10 and metrics["misses"] == 0 and metrics["scans"] >= 3
+    print "All discovery cache tests passed"
@@ -0,0 +1,91 @@
+from AsyncTCPConnection import AsyncTCPConnection, EventLoop
+import AsyncTCPConnection as async_module
+import PacketConnection
+import TCPServer as server_module
+from TCPServer import TCPServer
+from Packet import Packet
+import time
+
+num_clients = 500
+port = 5010
+
+
+class EchoServer():
+    """ Echoes every packet back to the client that sent it """
+    def __init__(self, loop):
+        self.conn = TCPServer(self.callback, loop)
+
+    def connect(self):
+        self.conn.createServer(port = port, backlog = num_clients)
+
+    def callback(self, client_id, pck):
+        self.conn.sendPacket(client_id, pck)
+
+
+class Client():
+    def __init__(self, loop, number):
+        self.number = number
+        self.received = []
+        self.conn = AsyncTCPConnection(self.callback, loop)
+
+    def connect(self):
+        self.conn.createClient("127.0.0.1", port)
+
+    def callback(self, pck):
+        self.received.append(pck.get_int())
+
+
+def wait_for(condition, timeout = 20):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(.01)
+    return True
+
+
+if __name__=="__main__":
+    async_module.D = False
+    server_module.D = False
+    PacketConnection.D = False
+
+    server_loop = EventLoop()
+    client_loop = EventLoop()
+    server_loop.start()
+    client_loop.start()
+    try:
+        server = EchoServer(server_loop)
+        server.connect()
+
+        clients = [Client(client_loop, i) for i in range(num_clients)]
+        for client in clients:
+            client.connect()
+        assert wait_for(lambda: len(server.conn.clients()) == num_clients), "Not all clients were accepted"
+        assert wait_for(lambda: all(client.conn.is_ready() for client in clients)), "Not all clients connected"
+        print "%d clients connected" % num_clients
+
+        # Every client receives the echo of its own number
+        start = time.time()
+        for client in clients:
+            pck = Packet()
+            pck.put_int(client.number)
+            client.conn.send(pck)
+        assert wait_for(lambda: all(len(client.received) == 1 for client in clients)), "Not all echoes arrived"
+        assert all(client.received == [client.number] for client in clients), "Echo went to the wrong client"
+        print "Echo to all clients took %.3fs" % (time.time() - start)
+
+        # Every client receives the broadcast
+        pck = Packet()
+        pck.put_int(-1)
+        server.conn.broadcast(pck)
+        assert wait_for(lambda: all(len(client.received) == 2 for client in clients)), "Not all broadcasts arrived"
+        assert all(client.received[1] == -1 for client in clients)
+        print "Broadcast arrived at all clients"
+
+        for client in clients:
+            client.conn.closeConnection()
+        assert wait_for(lambda: len(server.conn.clients()) == 0), "Server did not notice disconnects"
+        print "All clients disconnected"
+    finally:
+        server_loop.stop()
+        client_loop.stop()
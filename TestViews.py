@@ -0,0 +1,60 @@
+from Packet import Packet
+from Schema import Schema, int_type, string_type
+
+payload = "0123456789abcdef"
+growth = 10 << 20
+
+
+def string_packet(buffered):
+    pck = Packet(buffered = buffered)
+    pck.append_string(payload)
+    pck.position = 0
+    return pck
+
+
+if __name__=="__main__":
+    # A view of a string packet keeps the old string alive when the packet grows
+    pck = string_packet(False)
+    view = pck.pop_string_view()
+    pck.append_bytes("\x00" * growth)
+    assert view.tobytes() == payload
+    print "View of a string packet is unchanged after appending %d bytes" % growth
+
+    # A buffered packet refuses to grow while a view of it exists, instead of leaving the view dangling
+    for take_view, length in ((lambda pck: pck.pop_string_view(), len(payload)),
+                              (lambda pck: pck.pop_bytes_view(4), 4),
+                              (lambda pck: pck.view_data(), 4 + len(payload))):
+        pck = string_packet(True)
+        expected = str(pck.get_data())
+        view = take_view(pck)
+        try:
+            pck.append_bytes("\x00" * growth)
+            assert False, "A buffered packet grew while a view of it existed"
+        except BufferError:
+            pass
+        assert view.tobytes() in (expected[:length], expected[-length:])
+        del view
+        pck.append_bytes("\x00" * growth)   # Possible again once the view is gone
+    print "Buffered packets raise a BufferError while they are viewed"
+
+    # The same holds for string fields of lazily decoded records
+    schema = Schema([("id", int_type), ("name", string_type)])
+    pck = Packet(buffered = True)
+    schema.pack({"id": 1, "name": payload}, pck)
+    pck.position = 0
+    record = next(pck.iter_records(schema))
+    view = record.view("name")
+    try:
+        pck.append_bytes("\x00" * growth)
+        assert False, "A buffered packet grew while a record view of it existed"
+    except BufferError:
+        pass
+    assert view.tobytes() == payload
+    print "Record views hold on to the packet data"
+
+    try:
+        Schema([])
+        assert False, "An empty schema was accepted"
+    except ValueError:
+        pass
+    print "All view tests passed"
@@ -0,0 +1,63 @@
+"""
+Registry of the transports a FramedPacketConnection can run on. A transport is registered by the module
+and class name of its connection, and the module is only imported when the transport is used for the
+first time. A process that only uses TCP therefore never imports PyBluez, and a missing backend only
+fails when it is requested:
+
+    import Transports
+    conn = Transports.create("tcp", callback)
+    conn.createClient("192.168.0.2")
+"""
+import importlib
+from threading import Lock
+
+_registry = {}   # name -> (module name, class name)
+_loaded = {}     # name -> class
+_lock = Lock()
+
+
+""" Registers a transport under name. The class is imported from the module when it is first requested. """
+def register(name, module, class_name):
+    with _lock:
+        _registry[name] = (module, class_name)
+        _loaded.pop(name, None)
+
+
+""" Returns the names of all registered transports """
+def names():
+    return sorted(_registry)
+
+
+""" Returns the connection class of a transport, importing its module if needed. Raises a KeyError for an
+    unknown transport and an ImportError if the backend of the transport is not installed. """
+def get(name):
+    cls = _loaded.get(name)
+    if cls is not None:
+        return cls
+    with _lock:
+        if name not in _registry:
+            raise KeyError("Unknown transport " + repr(name) + ", registered are " + ", ".join(sorted(_registry)))
+        module, class_name = _registry[name]
+        cls = getattr(importlib.import_module(module), class_name)
+        _loaded[name] = cls
+    return cls
+
+
+""" Returns whether the backend of a transport can be imported """
+def available(name):
+    try:
+        get(name)
+        return True
+    except ImportError:
+        return False
+
+
+""" Creates a connection of the given transport. The arguments are passed to its constructor. """
+def create(name, *args, **kwargs):
+    return get(name)(*args, **kwargs)
+
+
+register("tcp", "TCPConnection", "TCPConnection")
+register("async_tcp", "AsyncTCPConnection", "AsyncTCPConnection")
+register("bluetooth", "BluetoothConnection", "BluetoothConnection")
+register("loopback", "LoopbackConnection", "LoopbackConnection")